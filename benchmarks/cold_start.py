@@ -0,0 +1,125 @@
+# ==============================================================================
+# Cold-start benchmark: time to a healthy / and latency of the first /api/build
+# ==============================================================================
+"""
+Starts the fakes (see fakes.py) once, then launches the agent as a fresh uvicorn subprocess per run
+and measures, from the moment the process is spawned:
+
+  healthy      time until GET / first answers 200
+  accepted     time from sending the first /api/build until its 202
+  callback     time from sending the first /api/build until its evaluation callback
+
+Each run is repeated with STARTUP_PREWARM on and off:
+
+    python benchmarks/cold_start.py --runs 5 --build-delay 1
+
+The fakes answer on localhost, so connection set-up is nearly free here; against AIPipe and
+api.github.com the pre-warmed TLS connections save a further round trip or two per host.
+"""
+import argparse
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+import httpx
+
+from fakes import FakeEvaluator, FakeGitHub, FakeLLM
+from load_test import REPO_ROOT, SECRET, USERNAME, free_port, serve
+
+def cold_start(args, env: Dict[str, str], evaluator: FakeEvaluator, evaluator_url: str, run: int) -> Dict[str, float]:
+    workdir = tempfile.mkdtemp(prefix="agent-cold-")
+    port = free_port()
+    agent_url = f"http://127.0.0.1:{port}"
+    env = {
+        **env, "QUEUE_DB_PATH": os.path.join(workdir, "queue.db"),
+        "LLM_CACHE_DIR": os.path.join(workdir, "llm_cache"), "GIT_CACHE_DIR": os.path.join(workdir, "git_cache"),
+        "ATTACHMENT_DIR": os.path.join(workdir, "attachments"),
+    }
+    log = open(os.path.join(workdir, "agent.log"), "w")
+    spawned = time.monotonic()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+        cwd=REPO_ROOT, env={**os.environ, **env}, stdout=log, stderr=subprocess.STDOUT,
+    )
+    try:
+        with httpx.Client(timeout=30) as client:
+            while True:
+                if process.poll() is not None:
+                    raise RuntimeError(f"Agent exited during startup; see {log.name}")
+                if time.monotonic() - spawned > 60:
+                    raise RuntimeError(f"Agent did not start within 60 seconds; see {log.name}")
+                try:
+                    if client.get(f"{agent_url}/").status_code == 200:
+                        break
+                except httpx.HTTPError:
+                    pass
+                time.sleep(0.01)
+            healthy = time.monotonic() - spawned
+
+            time.sleep(args.build_delay)
+            task = f"cold-{int(time.time())}-{run}-{env['STARTUP_PREWARM']}"
+            sent = time.monotonic()
+            response = client.post(f"{agent_url}/api/build", json={
+                "email": "bench@example.com", "secret": SECRET, "task": task, "round": 1, "nonce": task,
+                "brief": f"Cold start page for {task}", "evaluation_url": evaluator_url,
+            })
+            response.raise_for_status()
+            accepted = time.monotonic() - sent
+
+        deadline = time.monotonic() + args.timeout
+        while not evaluator.received(task, 1) and time.monotonic() < deadline:
+            time.sleep(0.01)
+        received = evaluator.received(task, 1)
+        return {"healthy": healthy, "accepted": accepted, "callback": received - sent if received else float("nan")}
+    finally:
+        process.terminate()
+        process.wait(timeout=10)
+        log.close()
+        if args.keep:
+            print(f"  run {run} log: {log.name}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=3, help="Cold starts per mode (default 3)")
+    parser.add_argument("--build-delay", type=float, default=0.0, help="Seconds between healthy / and the first build (default 0)")
+    parser.add_argument("--llm-latency", type=float, default=1.0, help="Seconds per LLM answer (default 1)")
+    parser.add_argument("--pages-delay", type=float, default=0.5, help="Seconds until a Pages build is done (default 0.5)")
+    parser.add_argument("--timeout", type=float, default=60, help="Seconds to wait for a callback (default 60)")
+    parser.add_argument("--keep", action="store_true", help="Keep the agent's working directories and logs")
+    args = parser.parse_args()
+
+    llm_port, github_port, evaluator_port = (free_port() for _ in range(3))
+    github_url = f"http://127.0.0.1:{github_port}"
+    evaluator = FakeEvaluator()
+    for app, port in ((FakeLLM(latency=args.llm_latency).app, llm_port),
+                      (FakeGitHub(github_url, USERNAME, build_delay=args.pages_delay).app, github_port),
+                      (evaluator.app, evaluator_port)):
+        serve(app, port)
+    evaluator_url = f"http://127.0.0.1:{evaluator_port}/evaluate"
+    env = {
+        "MY_SECRET": SECRET, "AIPIPE_TOKEN": "benchmark", "GITHUB_TOKEN": "benchmark", "GITHUB_USERNAME": USERNAME,
+        "LLM_BASE_URL": f"http://127.0.0.1:{llm_port}/v1", "GITHUB_API_URL": github_url,
+        "GITHUB_WRITES_PER_MINUTE": "0", "GITHUB_WRITES_PER_HOUR": "0", "DEPLOY_BACKEND": "api",
+    }
+
+    results: Dict[str, List[Dict[str, float]]] = {}
+    for run in range(args.runs):
+        for prewarm in ("true", "false"):
+            print(f"Run {run + 1}, STARTUP_PREWARM={prewarm}...")
+            results.setdefault(prewarm, []).append(cold_start(args, {**env, "STARTUP_PREWARM": prewarm}, evaluator, evaluator_url, run))
+
+    print()
+    print("prewarm  runs   healthy  accepted  callback   (medians)")
+    for prewarm, runs in results.items():
+        medians = [statistics.median(run[key] for run in runs) for key in ("healthy", "accepted", "callback")]
+        print(f"{prewarm:>7}  {len(runs):>4}  " + "  ".join(f"{value:7.3f}s" for value in medians))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,332 @@
+# ==============================================================================
+# Local stand-ins for the services the deployment agent talks to
+# ==============================================================================
+import asyncio
+import base64
+import hashlib
+import io
+import json
+import math
+import random
+import tarfile
+import threading
+import time
+import uuid
+from collections import deque
+from typing import Dict, List, Optional
+
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+
+# === Fake OpenAI-compatible LLM ===
+class FakeLLM:
+    """
+    Answers /v1/chat/completions with a JSON file map of `files` files of about `file_size` bytes each.
+    The answer takes `latency` seconds: the first token arrives after `first_token` seconds and the
+    rest is spread over `chunks` stream chunks. A `stall_rate` fraction of answers takes
+    `stall_factor` times as long, and an `invalid_rate` fraction is cut off halfway (invalid JSON).
+    """
+
+    def __init__(self, latency: float = 2.0, first_token: float = 0.5, files: int = 3, file_size: int = 4000, chunks: int = 20,
+                 stall_rate: float = 0.0, stall_factor: float = 10.0, invalid_rate: float = 0.0, seed: int = 0):
+        self.latency = latency
+        self.first_token = min(first_token, latency)
+        self.files = files
+        self.file_size = file_size
+        self.chunks = chunks
+        self.stall_rate = stall_rate
+        self.stall_factor = stall_factor
+        self.invalid_rate = invalid_rate
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.app = FastAPI()
+        self.app.post("/v1/chat/completions")(self.completions)
+
+    def file_map(self, prompt: str) -> Dict[str, str]:
+        # Vary the output with the prompt so different tasks produce different files
+        seed = hashlib.sha1(prompt.encode()).hexdigest()
+        filler = (seed * (self.file_size // len(seed) + 1))[:self.file_size]
+        files = {"index.html": f"<!DOCTYPE html>\n<html><body><h1>{seed[:8]}</h1>\n<!-- {filler} -->\n</body></html>\n"}
+        for i in range(1, self.files):
+            files[f"script{i}.js"] = f"// {seed}\nconsole.log({i});\n/* {filler} */\n"
+        return files
+
+    async def completions(self, request: Request):
+        body = await request.json()
+        self.requests += 1
+        prompt = body["messages"][-1]["content"]
+        content = json.dumps(self.file_map(prompt))
+        usage = {"prompt_tokens": len(prompt) // 4, "completion_tokens": len(content) // 4, "total_tokens": (len(prompt) + len(content)) // 4}
+        latency, first_token = self.latency, self.first_token
+        if self.random.random() < self.stall_rate:
+            latency, first_token = latency * self.stall_factor, first_token * self.stall_factor
+        if self.random.random() < self.invalid_rate:
+            content = content[:len(content) // 2]
+        if not body.get("stream"):
+            await asyncio.sleep(latency)
+            return {
+                "id": "chatcmpl-fake", "object": "chat.completion", "created": int(time.time()), "model": body["model"],
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+                "usage": usage,
+            }
+
+        async def events():
+            await asyncio.sleep(first_token)
+            step = len(content) // self.chunks + 1
+            for start in range(0, len(content), step):
+                chunk = {
+                    "id": "chatcmpl-fake", "object": "chat.completion.chunk", "created": int(time.time()), "model": body["model"],
+                    "choices": [{"index": 0, "delta": {"content": content[start:start + step]}, "finish_reason": None}],
+                }
+                yield f"data: {json.dumps(chunk)}\n\n"
+                await asyncio.sleep((latency - first_token) / self.chunks)
+            if (body.get("stream_options") or {}).get("include_usage"):
+                final = {"id": "chatcmpl-fake", "object": "chat.completion.chunk", "created": int(time.time()),
+                         "model": body["model"], "choices": [], "usage": usage}
+                yield f"data: {json.dumps(final)}\n\n"
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+# === Fake GitHub REST, Git data and Pages APIs ===
+def git_blob_sha(data: bytes) -> str:
+    return hashlib.sha1(b"blob %d\0" % len(data) + data).hexdigest()
+
+class FakeGitHub:
+    """
+    In-memory GitHub covering the endpoints the agent uses. Every request is counted; Pages builds
+    for a pushed commit report "built" `build_delay` seconds after the branch moved.
+    The primary rate limit allows `rate_limit` requests per `rate_limit_window` seconds; with
+    `write_limit` set, more than that many content-creating requests within `write_window` seconds
+    are rejected like GitHub's secondary rate limit (403 with Retry-After).
+    """
+
+    def __init__(self, base_url: str, login: str, build_delay: float = 1.0, rate_limit: int = 5000, rate_limit_window: float = 3600.0,
+                 write_limit: int = 0, write_window: float = 60.0):
+        self.base_url = base_url.rstrip("/")
+        self.login = login
+        self.build_delay = build_delay
+        self.repos: Dict[str, Dict] = {}
+        self.requests = 0
+        self.rejected = 0
+        self.rate_limit = rate_limit
+        self.rate_limit_window = rate_limit_window
+        self.rate_limit_remaining = rate_limit
+        self.write_limit = write_limit
+        self.write_window = write_window
+        self._window_start = time.time()
+        self._writes: deque = deque()
+        self._lock = threading.Lock()
+        self.app = FastAPI()
+        self.app.middleware("http")(self.count_requests)
+        app = self.app
+        app.get("/user")(self.user)
+        app.post("/user/repos")(self.create_repo)
+        app.get("/repos/{owner}/{name}")(self.get_repo)
+        app.get("/repos/{owner}/{name}/git/ref/heads/{branch}")(self.get_ref)
+        app.get("/repos/{owner}/{name}/git/refs/heads/{branch}")(self.get_ref)
+        app.patch("/repos/{owner}/{name}/git/refs/heads/{branch}")(self.update_ref)
+        app.get("/repos/{owner}/{name}/git/commits/{sha}")(self.get_commit)
+        app.post("/repos/{owner}/{name}/git/commits")(self.create_commit)
+        app.post("/repos/{owner}/{name}/git/blobs")(self.create_blob)
+        app.get("/repos/{owner}/{name}/git/trees/{sha}")(self.get_tree)
+        app.post("/repos/{owner}/{name}/git/trees")(self.create_tree)
+        app.post("/repos/{owner}/{name}/pages")(self.enable_pages)
+        app.get("/repos/{owner}/{name}/pages/builds")(self.pages_builds)
+        app.get("/repos/{owner}/{name}/tarball/{ref}")(self.tarball)
+
+    async def count_requests(self, request: Request, call_next):
+        now = time.time()
+        limited: Optional[Response] = None
+        with self._lock:
+            self.requests += 1
+            if now >= self._window_start + self.rate_limit_window:
+                self._window_start, self.rate_limit_remaining = now, self.rate_limit
+            reset = int(self._window_start + self.rate_limit_window) + 1
+            if not self.rate_limit_remaining:
+                limited = JSONResponse({"message": "API rate limit exceeded for user."}, status_code=403)
+            elif self.write_limit and request.method in ("POST", "PATCH", "PUT", "DELETE"):
+                while self._writes and self._writes[0] <= now - self.write_window:
+                    self._writes.popleft()
+                if len(self._writes) >= self.write_limit:
+                    retry_after = math.ceil(self._writes[0] + self.write_window - now)
+                    limited = JSONResponse(
+                        {"message": "You have exceeded a secondary rate limit. Please wait a few minutes before you try again."},
+                        status_code=403, headers={"retry-after": str(retry_after)},
+                    )
+                else:
+                    self._writes.append(now)
+            if limited is None:
+                self.rate_limit_remaining -= 1
+            else:
+                self.rejected += 1
+            remaining = self.rate_limit_remaining
+        response = limited or await call_next(request)
+        response.headers["x-ratelimit-limit"] = str(self.rate_limit)
+        response.headers["x-ratelimit-remaining"] = str(remaining)
+        response.headers["x-ratelimit-reset"] = str(reset)
+        response.headers["x-ratelimit-resource"] = "core"
+        return response
+
+    def _repo(self, name: str) -> Dict:
+        repo = self.repos.get(name)
+        if repo is None:
+            raise HTTPException(status_code=404, detail="Not Found")
+        return repo
+
+    def _repo_json(self, name: str) -> Dict:
+        return {
+            "id": abs(hash(name)) % 10**9, "name": name, "full_name": f"{self.login}/{name}",
+            "owner": {"login": self.login}, "private": False, "default_branch": "main",
+            "html_url": f"https://github.com/{self.login}/{name}", "url": f"{self.base_url}/repos/{self.login}/{name}",
+        }
+
+    def _commit_json(self, name: str, sha: str) -> Dict:
+        commit = self._repo(name)["commits"][sha]
+        return {
+            "sha": sha, "url": f"{self.base_url}/repos/{self.login}/{name}/git/commits/{sha}", "message": commit["message"],
+            "tree": {"sha": commit["tree"], "url": f"{self.base_url}/repos/{self.login}/{name}/git/trees/{commit['tree']}"},
+            "parents": [{"sha": parent} for parent in commit["parents"]],
+        }
+
+    def _store_tree(self, repo: Dict, entries: Dict[str, str]) -> str:
+        sha = hashlib.sha1(json.dumps(sorted(entries.items())).encode()).hexdigest()
+        repo["trees"][sha] = entries
+        return sha
+
+    def user(self):
+        return {"login": self.login, "url": f"{self.base_url}/users/{self.login}"}
+
+    async def create_repo(self, request: Request):
+        body = await request.json()
+        name = body["name"]
+        with self._lock:
+            if name in self.repos:
+                return JSONResponse({"message": "Repository creation failed.", "errors": [{"message": "name already exists on this account"}]}, status_code=422)
+            repo = {"blobs": {}, "trees": {}, "commits": {}, "ref": None, "builds": []}
+            readme = f"# {name}\n".encode()
+            readme_sha = git_blob_sha(readme)
+            repo["blobs"][readme_sha] = readme
+            tree = self._store_tree(repo, {"README.md": readme_sha})
+            root = uuid.uuid4().hex[:40]
+            repo["commits"][root] = {"tree": tree, "parents": [], "message": "Initial commit"}
+            repo["ref"] = root
+            self.repos[name] = repo
+        return JSONResponse(self._repo_json(name), status_code=201)
+
+    def get_repo(self, owner: str, name: str):
+        self._repo(name)
+        return self._repo_json(name)
+
+    def get_ref(self, owner: str, name: str, branch: str):
+        repo = self._repo(name)
+        return {
+            "ref": f"refs/heads/{branch}", "url": f"{self.base_url}/repos/{owner}/{name}/git/refs/heads/{branch}",
+            "object": {"sha": repo["ref"], "type": "commit", "url": f"{self.base_url}/repos/{owner}/{name}/git/commits/{repo['ref']}"},
+        }
+
+    async def update_ref(self, owner: str, name: str, branch: str, request: Request):
+        body = await request.json()
+        repo = self._repo(name)
+        with self._lock:
+            repo["ref"] = body["sha"]
+            repo["builds"].append({"commit": body["sha"], "at": time.monotonic()})
+        return self.get_ref(owner, name, branch)
+
+    def get_commit(self, owner: str, name: str, sha: str):
+        if sha not in self._repo(name)["commits"]:
+            raise HTTPException(status_code=404, detail="Not Found")
+        return self._commit_json(name, sha)
+
+    async def create_commit(self, owner: str, name: str, request: Request):
+        body = await request.json()
+        repo = self._repo(name)
+        sha = uuid.uuid4().hex[:40]
+        repo["commits"][sha] = {"tree": body["tree"], "parents": body.get("parents", []), "message": body["message"]}
+        return JSONResponse(self._commit_json(name, sha), status_code=201)
+
+    async def create_blob(self, owner: str, name: str, request: Request):
+        body = await request.json()
+        data = body["content"].encode() if body.get("encoding", "utf-8") == "utf-8" else base64.b64decode(body["content"])
+        sha = git_blob_sha(data)
+        self._repo(name)["blobs"][sha] = data
+        return JSONResponse({"sha": sha, "url": f"{self.base_url}/repos/{owner}/{name}/git/blobs/{sha}"}, status_code=201)
+
+    def _tree_json(self, owner: str, name: str, sha: str) -> Dict:
+        entries = self._repo(name)["trees"][sha]
+        return {
+            "sha": sha, "url": f"{self.base_url}/repos/{owner}/{name}/git/trees/{sha}", "truncated": False,
+            "tree": [{"path": path, "mode": "100644", "type": "blob", "sha": blob} for path, blob in sorted(entries.items())],
+        }
+
+    def get_tree(self, owner: str, name: str, sha: str):
+        if sha not in self._repo(name)["trees"]:
+            raise HTTPException(status_code=404, detail="Not Found")
+        return self._tree_json(owner, name, sha)
+
+    async def create_tree(self, owner: str, name: str, request: Request):
+        body = await request.json()
+        repo = self._repo(name)
+        entries = dict(repo["trees"][body["base_tree"]]) if body.get("base_tree") else {}
+        for element in body["tree"]:
+            if "content" in element:
+                data = element["content"].encode()
+                blob = git_blob_sha(data)
+                repo["blobs"][blob] = data
+            else:
+                blob = element.get("sha")
+            if blob is None:
+                entries.pop(element["path"], None)
+            else:
+                entries[element["path"]] = blob
+        sha = self._store_tree(repo, entries)
+        return JSONResponse(self._tree_json(owner, name, sha), status_code=201)
+
+    def enable_pages(self, owner: str, name: str):
+        repo = self._repo(name)
+        if repo.get("pages"):
+            return JSONResponse({"message": "GitHub Pages is already configured for this repository"}, status_code=422)
+        repo["pages"] = True
+        return JSONResponse({"url": f"{self.base_url}/repos/{owner}/{name}/pages", "status": None}, status_code=201)
+
+    def pages_builds(self, owner: str, name: str, per_page: int = 30):
+        repo = self._repo(name)
+        now = time.monotonic()
+        builds = [
+            {"commit": build["commit"], "status": "built" if now - build["at"] >= self.build_delay else "building"}
+            for build in reversed(repo["builds"])
+        ]
+        return builds[:per_page]
+
+    def tarball(self, owner: str, name: str, ref: str):
+        repo = self._repo(name)
+        entries = repo["trees"][repo["commits"][repo["ref"]]["tree"]]
+        buffer = io.BytesIO()
+        prefix = f"{owner}-{name}-{repo['ref'][:7]}"
+        with tarfile.open(fileobj=buffer, mode="w:gz") as archive:
+            for path, blob in entries.items():
+                data = repo["blobs"][blob]
+                info = tarfile.TarInfo(f"{prefix}/{path}")
+                info.size = len(data)
+                archive.addfile(info, io.BytesIO(data))
+        return Response(buffer.getvalue(), media_type="application/x-gzip")
+
+# === Fake evaluation server ===
+class FakeEvaluator:
+    """Records every evaluation callback with the time it arrived."""
+
+    def __init__(self):
+        self.callbacks: List[Dict] = []
+        self.app = FastAPI()
+        self.app.post("/evaluate")(self.evaluate)
+
+    async def evaluate(self, request: Request):
+        payload = await request.json()
+        self.callbacks.append({"received": time.monotonic(), **payload})
+        return {"status": "ok"}
+
+    def received(self, task: str, round_: int) -> Optional[float]:
+        for callback in self.callbacks:
+            if callback["task"] == task and callback["round"] == round_:
+                return callback["received"]
+        return None
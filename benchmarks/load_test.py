@@ -0,0 +1,204 @@
+# ==============================================================================
+# Offline end-to-end benchmark: bursts of /api/build requests against local fakes
+# ==============================================================================
+"""
+Starts the fake LLM, GitHub and evaluator (see fakes.py) in this process and the agent itself
+as a uvicorn subprocess pointed at them. It then sends a burst of round-1 requests, waits for
+every evaluation callback, and repeats with round-2 requests for the same tasks.
+
+    python benchmarks/load_test.py --builds 20 --llm-latency 2 --pages-delay 1
+
+Reports accepted requests/s, end-to-end latency percentiles (request sent -> callback received)
+and GitHub API calls per build for each round.
+"""
+import argparse
+import asyncio
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import Dict, List, Optional
+
+import httpx
+import uvicorn
+
+from fakes import FakeEvaluator, FakeGitHub, FakeLLM
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SECRET = "benchmark-secret"
+USERNAME = "bench"
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def serve(app, port: int) -> uvicorn.Server:
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return server
+
+def percentile(values: List[float], fraction: float) -> float:
+    """Nearest-rank percentile."""
+    ordered = sorted(values)
+    return ordered[max(0, min(len(ordered) - 1, int(round(fraction * len(ordered) + 0.5)) - 1))]
+
+def start_agent(port: int, env: Dict[str, str], log_path: str) -> subprocess.Popen:
+    log = open(log_path, "w")
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+        cwd=REPO_ROOT, env={**os.environ, **env}, stdout=log, stderr=subprocess.STDOUT,
+    )
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Agent exited during startup; see {log_path}")
+        try:
+            httpx.get(f"http://127.0.0.1:{port}/", timeout=1)
+            return process
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError(f"Agent did not start within 60 seconds; see {log_path}")
+
+async def send_burst(agent_url: str, evaluator_url: str, tasks: List[str], round_: int, run_id: str) -> Dict:
+    """Send one request per task concurrently; return the send times and the accept rate."""
+    sent: Dict[str, float] = {}
+
+    async def submit(client: httpx.AsyncClient, task: str):
+        body = {
+            "email": "bench@example.com", "secret": SECRET, "task": task, "round": round_,
+            "nonce": f"{run_id}-{task}-{round_}", "brief": f"Round {round_} page for {task}",
+            "evaluation_url": evaluator_url,
+        }
+        sent[task] = time.monotonic()
+        response = await client.post(f"{agent_url}/api/build", json=body)
+        response.raise_for_status()
+
+    limits = httpx.Limits(max_connections=len(tasks), max_keepalive_connections=len(tasks))
+    async with httpx.AsyncClient(timeout=30, limits=limits) as client:
+        start = time.monotonic()
+        await asyncio.gather(*(submit(client, task) for task in tasks))
+        elapsed = time.monotonic() - start
+    return {"sent": sent, "accept_seconds": elapsed, "accepted_per_second": len(tasks) / elapsed if elapsed else float("inf")}
+
+def wait_for_callbacks(evaluator: FakeEvaluator, tasks: List[str], round_: int, timeout: float) -> Dict[str, Optional[float]]:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        received = {task: evaluator.received(task, round_) for task in tasks}
+        if all(received.values()):
+            return received
+        time.sleep(0.1)
+    return {task: evaluator.received(task, round_) for task in tasks}
+
+def run_round(args, agent_url: str, evaluator_url: str, github: FakeGitHub, evaluator: FakeEvaluator, tasks: List[str], round_: int, run_id: str) -> Dict:
+    github_before = github.requests
+    burst = asyncio.run(send_burst(agent_url, evaluator_url, tasks, round_, run_id))
+    received = wait_for_callbacks(evaluator, tasks, round_, args.timeout)
+    latencies = [received[task] - burst["sent"][task] for task in tasks if received[task]]
+    completed = len(latencies)
+    return {
+        "round": round_, "builds": len(tasks), "completed": completed,
+        "accepted_per_second": burst["accepted_per_second"],
+        "p50": percentile(latencies, 0.50) if latencies else None,
+        "p90": percentile(latencies, 0.90) if latencies else None,
+        "p99": percentile(latencies, 0.99) if latencies else None,
+        "max": max(latencies) if latencies else None,
+        "github_calls_per_build": (github.requests - github_before) / completed if completed else None,
+    }
+
+def print_report(results: List[Dict]):
+    def seconds(value: Optional[float]) -> str:
+        return f"{value:7.2f}s" if value is not None else "      -"
+
+    print()
+    print("round  builds  done  accepted/s      p50      p90      p99      max  GitHub calls/build")
+    for result in results:
+        calls = result["github_calls_per_build"]
+        calls_text = f"{calls:>18.1f}" if calls is not None else f"{'-':>18}"
+        print(
+            f"{result['round']:>5}  {result['builds']:>6}  {result['completed']:>4}  {result['accepted_per_second']:>10.1f}"
+            f"  {seconds(result['p50'])}  {seconds(result['p90'])}  {seconds(result['p99'])}  {seconds(result['max'])}"
+            f"  {calls_text}"
+        )
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--builds", type=int, default=10, help="Tasks per burst (default 10)")
+    parser.add_argument("--rounds", type=int, default=2, help="Rounds per task (default 2)")
+    parser.add_argument("--workers", type=int, default=4, help="BUILD_WORKERS for the agent (default 4)")
+    parser.add_argument("--llm-latency", type=float, default=2.0, help="Seconds per LLM answer (default 2)")
+    parser.add_argument("--llm-files", type=int, default=3, help="Files per LLM answer (default 3)")
+    parser.add_argument("--llm-file-size", type=int, default=4000, help="Bytes per generated file (default 4000)")
+    parser.add_argument("--llm-stall-rate", type=float, default=0.0, help="Fraction of LLM answers that stall (default 0)")
+    parser.add_argument("--llm-stall-factor", type=float, default=10.0, help="How many times slower a stalled answer is (default 10)")
+    parser.add_argument("--llm-invalid-rate", type=float, default=0.0, help="Fraction of LLM answers cut off as invalid JSON (default 0)")
+    parser.add_argument("--pages-delay", type=float, default=1.0, help="Seconds until a Pages build is done (default 1)")
+    parser.add_argument("--writes-per-minute", type=int, default=None, help="GITHUB_WRITES_PER_MINUTE for the agent, 0 = off (default: the agent's own)")
+    parser.add_argument("--writes-per-hour", type=int, default=None, help="GITHUB_WRITES_PER_HOUR for the agent, 0 = off (default: the agent's own)")
+    parser.add_argument("--github-write-limit", type=int, default=0, help="Fake secondary limit: writes per --github-write-window (default off)")
+    parser.add_argument("--github-write-window", type=float, default=60.0, help="Window of the fake secondary limit in seconds (default 60)")
+    parser.add_argument("--github-rate-limit", type=int, default=5000, help="Fake primary limit per hour (default 5000)")
+    parser.add_argument("--timeout", type=float, default=300, help="Seconds to wait for the callbacks of a burst (default 300)")
+    parser.add_argument("--agent-env", action="append", default=[], metavar="NAME=VALUE", help="Extra environment for the agent (repeatable)")
+    parser.add_argument("--keep", action="store_true", help="Keep the agent's working directory and log")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="agent-bench-")
+    llm_port, github_port, evaluator_port, agent_port = (free_port() for _ in range(4))
+    github_url = f"http://127.0.0.1:{github_port}"
+    llm = FakeLLM(
+        latency=args.llm_latency, files=args.llm_files, file_size=args.llm_file_size,
+        stall_rate=args.llm_stall_rate, stall_factor=args.llm_stall_factor, invalid_rate=args.llm_invalid_rate,
+    )
+    github = FakeGitHub(
+        github_url, USERNAME, build_delay=args.pages_delay, rate_limit=args.github_rate_limit,
+        write_limit=args.github_write_limit, write_window=args.github_write_window,
+    )
+    evaluator = FakeEvaluator()
+    for app, port in ((llm.app, llm_port), (github.app, github_port), (evaluator.app, evaluator_port)):
+        serve(app, port)
+
+    env = {
+        "MY_SECRET": SECRET, "AIPIPE_TOKEN": "benchmark", "GITHUB_TOKEN": "benchmark", "GITHUB_USERNAME": USERNAME,
+        "LLM_BASE_URL": f"http://127.0.0.1:{llm_port}/v1", "GITHUB_API_URL": github_url,
+        "BUILD_WORKERS": str(args.workers), "QUEUE_DB_PATH": os.path.join(workdir, "queue.db"),
+        "LLM_CACHE_DIR": os.path.join(workdir, "llm_cache"), "GIT_CACHE_DIR": os.path.join(workdir, "git_cache"),
+        "ATTACHMENT_DIR": os.path.join(workdir, "attachments"), "DEPLOY_BACKEND": "api",
+    }
+    if args.writes_per_minute is not None:
+        env["GITHUB_WRITES_PER_MINUTE"] = str(args.writes_per_minute)
+    if args.writes_per_hour is not None:
+        env["GITHUB_WRITES_PER_HOUR"] = str(args.writes_per_hour)
+    env.update(item.split("=", 1) for item in args.agent_env)
+    log_path = os.path.join(workdir, "agent.log")
+    agent = start_agent(agent_port, env, log_path)
+    agent_url = f"http://127.0.0.1:{agent_port}"
+    evaluator_url = f"http://127.0.0.1:{evaluator_port}/evaluate"
+
+    run_id = str(int(time.time()))
+    tasks = [f"bench-{run_id}-{i}" for i in range(args.builds)]
+    results = []
+    try:
+        for round_ in range(1, args.rounds + 1):
+            print(f"Round {round_}: sending {len(tasks)} requests...")
+            results.append(run_round(args, agent_url, evaluator_url, github, evaluator, tasks, round_, run_id))
+    finally:
+        agent.terminate()
+        agent.wait(timeout=10)
+
+    print_report(results)
+    print(f"\nLLM requests: {llm.requests}, GitHub requests: {github.requests} ({github.rejected} rate-limited), callbacks: {len(evaluator.callbacks)}")
+    if args.keep:
+        print(f"Agent working directory and log: {workdir}")
+    else:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
@@ -3,30 +3,108 @@
 # ==============================================================================
 import os
 import time
+import asyncio
+import random
 import base64
 import traceback
 import re
-from typing import List, Optional, Dict, Tuple
+import tempfile
+import csv
+import io
+import tarfile
+import shutil
+import hashlib
+import json
+import sqlite3
+import threading
+import contextvars
+import functools
+import heapq
+import importlib
+import itertools
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+from typing import IO, TYPE_CHECKING, Awaitable, Callable, List, Optional, Dict, Tuple, Union
+
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import PlainTextResponse
+from pydantic import BaseModel, HttpUrl, Field, ValidationError
 
-from fastapi import FastAPI, HTTPException, BackgroundTasks
-from pydantic import BaseModel, HttpUrl, Field
-
-from openai import OpenAI
 from dotenv import load_dotenv
-from github import Github, GithubException, UnknownObjectException
-import requests
+import httpx
+
+if TYPE_CHECKING:
+    from git import Repo as GitRepo
+    from openai import AsyncOpenAI
+
+@functools.lru_cache(maxsize=None)
+def lazy_import(name: str, optional: bool = False):
+    """
+    Import a module on first use. openai, GitPython and tiktoken are about half of this file's
+    import time, so they are loaded when needed (or by the startup pre-warm) instead of at import.
+    Optional modules that are not installed return None.
+    """
+    try:
+        return importlib.import_module(name)
+    except ImportError:
+        if optional:
+            return None
+        raise
 
 # Load environment variables
 load_dotenv()
 
 class Config:
     LLM_MODEL: str = os.getenv("LLM_MODEL", "openai/gpt-4o")
+    LLM_BASE_URL: str = os.getenv("LLM_BASE_URL", "https://aipipe.org/openrouter/v1")
     MY_SECRET: str = os.getenv("MY_SECRET", "my-super-secret-123")
     AIPIPE_TOKEN: str = os.getenv("AIPIPE_TOKEN")
     GITHUB_TOKEN: str = os.getenv("GITHUB_TOKEN")
     GITHUB_USERNAME: str = os.getenv("GITHUB_USERNAME")
+    GITHUB_API_URL: str = os.getenv("GITHUB_API_URL", "https://api.github.com")
+    GITHUB_POOL_SIZE: int = int(os.getenv("GITHUB_POOL_SIZE", 10))
+    GITHUB_CACHE_TTL: int = int(os.getenv("GITHUB_CACHE_TTL", 300))
+    # GitHub's secondary limits on content-creating requests; 0 turns a budget off
+    GITHUB_WRITES_PER_MINUTE: int = int(os.getenv("GITHUB_WRITES_PER_MINUTE", 80))
+    GITHUB_WRITES_PER_HOUR: int = int(os.getenv("GITHUB_WRITES_PER_HOUR", 500))
+    GITHUB_RATE_LIMIT_RESERVE: int = int(os.getenv("GITHUB_RATE_LIMIT_RESERVE", 20))
+    GITHUB_MAX_BACKOFF: float = float(os.getenv("GITHUB_MAX_BACKOFF", 900))
     DEPLOYMENT_TIMEOUT: int = int(os.getenv("DEPLOYMENT_TIMEOUT", 180))
+    QUEUE_DB_PATH: str = os.getenv("QUEUE_DB_PATH", "build_queue.db")
+    BUILD_WORKERS: int = int(os.getenv("BUILD_WORKERS", 50))
+    BUILD_MAX_ATTEMPTS: int = int(os.getenv("BUILD_MAX_ATTEMPTS", 3))
+    BUILD_DEADLINE: float = float(os.getenv("BUILD_DEADLINE", 600))  # seconds after submission; orders GitHub writes
+    REVISION_DEADLINE: float = float(os.getenv("REVISION_DEADLINE", 300))  # the same for round 2+
+    LLM_STREAMING: bool = os.getenv("LLM_STREAMING", "true").lower() in ("1", "true", "yes")
+    STARTUP_PREWARM: bool = os.getenv("STARTUP_PREWARM", "true").lower() in ("1", "true", "yes")
+    LLM_TIMEOUT: float = float(os.getenv("LLM_TIMEOUT", 120))
+    LLM_FALLBACK_MODELS: List[str] = [m.strip() for m in os.getenv("LLM_FALLBACK_MODELS", "").split(",") if m.strip()]
+    LLM_MAX_ATTEMPTS: int = int(os.getenv("LLM_MAX_ATTEMPTS", 3))
+    LLM_HEDGE_PERCENTILE: float = float(os.getenv("LLM_HEDGE_PERCENTILE", 0.9))
+    LLM_HEDGE_DELAY: float = float(os.getenv("LLM_HEDGE_DELAY", 60))  # used until enough latencies are recorded
+    LLM_CACHE_DIR: str = os.getenv("LLM_CACHE_DIR", ".llm_cache")
+    LLM_CACHE_MEMORY_ITEMS: int = int(os.getenv("LLM_CACHE_MEMORY_ITEMS", 64))
+    LLM_CACHE_MAX_BYTES: int = int(os.getenv("LLM_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+    NOTIFY_RETRY_HORIZON: int = int(os.getenv("NOTIFY_RETRY_HORIZON", 3600))
+    NOTIFY_BACKOFF_BASE: float = float(os.getenv("NOTIFY_BACKOFF_BASE", 1))
+    NOTIFY_BACKOFF_MAX: float = float(os.getenv("NOTIFY_BACKOFF_MAX", 300))
+    NOTIFY_TIMEOUT: float = float(os.getenv("NOTIFY_TIMEOUT", 20))
+    PROMPT_TOKEN_BUDGET: int = int(os.getenv("PROMPT_TOKEN_BUDGET", 24000))
+    LLM_COMPLETION_RESERVE: int = int(os.getenv("LLM_COMPLETION_RESERVE", 16000))
+    ATTACHMENT_INLINE_CHARS: int = int(os.getenv("ATTACHMENT_INLINE_CHARS", 16000))
+    REVISION_INLINE_CHARS: int = int(os.getenv("REVISION_INLINE_CHARS", 20000))
+    DEPLOY_BACKEND: str = os.getenv("DEPLOY_BACKEND", "api").lower()  # "api" (Git Trees API) or "git" (git push)
+    GIT_REMOTE_BASE: str = os.getenv("GIT_REMOTE_BASE", "https://github.com")
+    GIT_CACHE_DIR: str = os.getenv("GIT_CACHE_DIR", ".git_cache")
     MAX_ATTACHMENT_SIZE: int = 10 * 1024 * 1024
+    MAX_REQUEST_ATTACHMENT_BYTES: int = int(os.getenv("MAX_REQUEST_ATTACHMENT_BYTES", 50 * 1024 * 1024))
+    ATTACHMENT_FETCH_CONCURRENCY: int = int(os.getenv("ATTACHMENT_FETCH_CONCURRENCY", 8))
+    ATTACHMENT_TIMEOUT: int = int(os.getenv("ATTACHMENT_TIMEOUT", 30))
+    ATTACHMENT_SPOOL_THRESHOLD: int = int(os.getenv("ATTACHMENT_SPOOL_THRESHOLD", 1024 * 1024))
+    ATTACHMENT_DIR: str = os.getenv("ATTACHMENT_DIR", ".attachments")
+    ATTACHMENT_STORE_MAX_BYTES: int = int(os.getenv("ATTACHMENT_STORE_MAX_BYTES", 1024 * 1024 * 1024))
 
 config = Config()
 
@@ -49,93 +127,1268 @@ class BuildRequest(BaseModel):
 app = FastAPI()
 
 @app.on_event("startup")
-def startup_event():
+async def startup_event():
     print("--- Performing startup validation of environment variables ---")
     if not config.AIPIPE_TOKEN: print("CRITICAL WARNING: AIPIPE_TOKEN is not set.")
     if not config.GITHUB_TOKEN: print("CRITICAL WARNING: GITHUB_TOKEN is not set.")
     if not config.GITHUB_USERNAME: print("CRITICAL WARNING: GITHUB_USERNAME is not set.")
     print("--- Startup validation complete. ---")
+    notification_outbox.start()
+    build_queue.start()
+    if config.STARTUP_PREWARM:
+        app.state.prewarm = asyncio.create_task(prewarm())
+
+async def prewarm():
+    """
+    Load the lazily imported modules and open pooled connections to the LLM endpoint and GitHub in
+    the background, so the first build after a cold start does not pay for them.
+    """
+    started = time.monotonic()
+    try:
+        for name in ["openai"] + (["git"] if config.DEPLOY_BACKEND == "git" else []):
+            await asyncio.to_thread(lazy_import, name)
+        # Loads (and on first use downloads) the tiktoken encoding for the model
+        _token_encoder_loads[config.LLM_MODEL] = time.monotonic()
+        await asyncio.to_thread(load_token_encoder, config.LLM_MODEL)
+    except Exception as e:
+        print(f"Warning: Pre-warm import failed: {e}")
+    results = await asyncio.gather(
+        llm_http.get().get(f"{config.LLM_BASE_URL.rstrip('/')}/models", headers={"Authorization": f"Bearer {config.AIPIPE_TOKEN}"}),
+        get_github_login(),
+        return_exceptions=True,
+    )
+    for target, result in zip(("LLM endpoint", "GitHub"), results):
+        if isinstance(result, Exception):
+            print(f"Warning: Pre-warming the {target} connection failed: {result!r}")
+    print(f"Pre-warm finished in {time.monotonic() - started:.2f}s.")
 
 def sanitize_filename(filename: str) -> str:
     sanitized = filename.replace("..", "")
     return re.sub(r'[^a-zA-Z0-9_.-]', '_', sanitized)
 
+# === Metrics ===
+class Metrics:
+    """
+    In-process counters, gauges and histograms rendered in the Prometheus text format, plus the
+    timing spans of recent jobs. The job being worked on is kept in a context variable (see begin_job),
+    so tasks and threads started by a job inherit it.
+    """
+    DEFAULT_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+    def __init__(self, recent_jobs: int = 200):
+        self.recent_jobs = recent_jobs
+        self._meta: Dict[str, Tuple[str, str, Tuple[float, ...]]] = {}
+        self._values: Dict[str, Dict[Tuple, Union[float, List]]] = {}
+        self._spans: "OrderedDict[Tuple[str, int], List[Dict]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._job: contextvars.ContextVar[Optional[Tuple[str, int]]] = contextvars.ContextVar("metrics_job", default=None)
+
+    def describe(self, name: str, kind: str, help_text: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self._meta[name] = (kind, help_text, buckets)
+        self._values[name] = {}
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[name][key] = self._values[name].get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels):
+        with self._lock:
+            self._values[name][tuple(sorted(labels.items()))] = value
+
+    def observe(self, name: str, value: float, **labels):
+        buckets = self._meta[name][2]
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            # [count per bucket..., sum, count]
+            series = self._values[name].setdefault(key, [0] * len(buckets) + [0.0, 0])
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def begin_job(self, task: str, round_: int):
+        """Attribute the spans of the current context to (task, round); a retried job starts with a clean record."""
+        job = (task, round_)
+        self._job.set(job)
+        with self._lock:
+            self._spans[job] = []
+            self._spans.move_to_end(job)
+            while len(self._spans) > self.recent_jobs:
+                self._spans.popitem(last=False)
+
+    def current_job(self) -> Optional[Tuple[str, int]]:
+        return self._job.get()
+
+    def record_span(self, job: Optional[Tuple[str, int]], stage: str, seconds: float, **details):
+        self.observe("build_stage_seconds", seconds, stage=stage)
+        if job is None:
+            return
+        print(f"[{job[0]} r{job[1]}] {stage}: {seconds:.2f}s")
+        with self._lock:
+            if job in self._spans:
+                self._spans[job].append({"stage": stage, "seconds": round(seconds, 3), **details})
+
+    @contextmanager
+    def span(self, stage: str):
+        """Time a stage of the current job (recorded even if the stage fails)."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_span(self.current_job(), stage, time.perf_counter() - start)
+
+    def job_spans(self, task: str, round_: int) -> List[Dict]:
+        with self._lock:
+            return list(self._spans.get((task, round_), []))
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            for name, (kind, help_text, buckets) in self._meta.items():
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                for key, value in self._values[name].items():
+                    if kind != "histogram":
+                        lines.append(f"{name}{format_labels(key)} {value}")
+                        continue
+                    for bound, count in zip(buckets, value):
+                        lines.append(f"{name}_bucket{format_labels(key + (('le', str(bound)),))} {count}")
+                    lines.append(f"{name}_bucket{format_labels(key + (('le', '+Inf'),))} {value[-1]}")
+                    lines.append(f"{name}_sum{format_labels(key)} {value[-2]}")
+                    lines.append(f"{name}_count{format_labels(key)} {value[-1]}")
+        return "\n".join(lines) + "\n"
+
+def format_labels(labels: Tuple[Tuple[str, object], ...]) -> str:
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in labels)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + "}"
+
+metrics = Metrics()
+metrics.describe("build_jobs_total", "counter", "Finished build jobs by status.")
+metrics.describe("build_job_seconds", "histogram", "Wall time of a build job, excluding Pages verification.")
+metrics.describe("build_stage_seconds", "histogram", "Wall time of each build stage.")
+metrics.describe("llm_requests_total", "counter", "LLM generations by result (ok, hedged, partial, error, cache_hit).")
+metrics.describe("llm_hedges_total", "counter", "Extra LLM attempts started, by reason (slow, failure, invalid).")
+metrics.describe("llm_prompt_tokens_total", "counter", "Prompt tokens sent to the LLM.")
+metrics.describe("llm_completion_tokens_total", "counter", "Completion tokens received from the LLM.")
+metrics.describe("attachment_fetches_total", "counter", "Attachment URL fetches by result (downloaded, not_modified).")
+metrics.describe("github_api_requests_total", "counter", "GitHub API requests.")
+metrics.describe("github_rate_limit_remaining", "gauge", "Remaining GitHub API rate limit from the last response.")
+metrics.describe("github_rate_limited_total", "counter", "GitHub responses rejected by a rate limit and retried, by status.")
+metrics.describe("github_scheduler_wait_seconds", "histogram", "Time GitHub requests waited in the scheduler, by kind (read, write).")
+metrics.describe("build_queue_jobs", "gauge", "Build jobs by status.")
+metrics.describe("pages_pending_deployments", "gauge", "Deployments waiting for their Pages build.")
+metrics.describe("notifications", "gauge", "Evaluation notifications by status.")
+
+# === Async HTTP clients ===
+class LoopBoundClient:
+    """
+    An httpx.AsyncClient created on first use in the running event loop (and recreated if the loop
+    changes), so module-level clients can be shared by every job without binding to a loop at import.
+    """
+
+    def __init__(self, **kwargs):
+        self._kwargs = kwargs
+        self._client: Optional[httpx.AsyncClient] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def get(self) -> httpx.AsyncClient:
+        loop = asyncio.get_running_loop()
+        if self._client is None or self._loop is not loop:
+            self._client = httpx.AsyncClient(**self._kwargs)
+            self._loop = loop
+        return self._client
+
+# === Attachment store ===
+BLOB_SHA_RE = re.compile(r"^[0-9a-f]{40}$")
+
+class AttachmentStore:
+    """
+    Content-addressed attachment files shared by every round and task. A file is named by its git
+    blob SHA, computed once when it is stored and reused by commits (see git_blob_sha).
+    Downloaded URLs are indexed with their ETag/Last-Modified, so a repeat is revalidated with a
+    conditional request instead of downloaded again. Files are evicted least recently used first once
+    the store exceeds max_bytes; files referenced by queued or running jobs are pinned.
+    """
+
+    def __init__(self, store_dir: str, max_bytes: int):
+        self.store_dir = os.path.normpath(store_dir)
+        self.url_dir = os.path.join(self.store_dir, "urls")
+        self.max_bytes = max_bytes
+        self._counts = {"deduplicated": 0, "revalidated": 0, "downloaded": 0}
+        self._pins: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        os.makedirs(self.url_dir, exist_ok=True)
+        # Incomplete files left behind by a crash
+        for name in os.listdir(self.store_dir):
+            if name.startswith(".incoming-"):
+                os.remove(os.path.join(self.store_dir, name))
+
+    def path(self, blob_sha: str) -> str:
+        return os.path.join(self.store_dir, blob_sha)
+
+    def blob_sha(self, content: IO[bytes]) -> Optional[str]:
+        """The precomputed blob SHA of a file opened from the store, otherwise None."""
+        name = getattr(content, "name", None)
+        if isinstance(name, str) and os.path.dirname(name) == self.store_dir and BLOB_SHA_RE.match(os.path.basename(name)):
+            return os.path.basename(name)
+        return None
+
+    def new_file(self) -> IO[bytes]:
+        """A temporary file to write new content into; pass it to add() or discard() when done."""
+        return tempfile.NamedTemporaryFile(dir=self.store_dir, prefix=".incoming-", delete=False)
+
+    def add(self, incoming: IO[bytes], pin: bool = False) -> Tuple[str, bool]:
+        """Move a completed new_file() into the store under its blob SHA; returns (SHA, newly created)."""
+        incoming.flush()
+        blob_sha = git_blob_sha(incoming)
+        incoming.close()
+        with self._lock:
+            if pin:
+                self._pins[blob_sha] = self._pins.get(blob_sha, 0) + 1
+            if os.path.exists(self.path(blob_sha)):
+                # Same content as an earlier attachment (another round or task)
+                os.remove(incoming.name)
+                os.utime(self.path(blob_sha))
+                self._counts["deduplicated"] += 1
+                return blob_sha, False
+            os.replace(incoming.name, self.path(blob_sha))
+            self._evict(keep=blob_sha)
+        return blob_sha, True
+
+    def count(self, outcome: str):
+        with self._lock:
+            self._counts[outcome] += 1
+
+    def discard(self, incoming: IO[bytes]):
+        incoming.close()
+        try:
+            os.remove(incoming.name)
+        except FileNotFoundError:
+            pass
+
+    def open(self, blob_sha: str) -> Optional[IO[bytes]]:
+        """Open a stored file (marking it recently used), or None if it was evicted."""
+        try:
+            content = open(self.path(blob_sha), "rb")
+        except FileNotFoundError:
+            return None
+        os.utime(self.path(blob_sha))
+        return content
+
+    def remove(self, blob_shas: List[str]):
+        """Delete stored files that no job references (content of a rejected request)."""
+        with self._lock:
+            for blob_sha in blob_shas:
+                if blob_sha not in self._pins:
+                    try:
+                        os.remove(self.path(blob_sha))
+                    except FileNotFoundError:
+                        pass
+
+    def pin(self, blob_shas: List[str]):
+        with self._lock:
+            for blob_sha in blob_shas:
+                self._pins[blob_sha] = self._pins.get(blob_sha, 0) + 1
+
+    def unpin(self, blob_shas: List[str]):
+        with self._lock:
+            for blob_sha in blob_shas:
+                if self._pins.get(blob_sha, 0) > 1:
+                    self._pins[blob_sha] -= 1
+                else:
+                    self._pins.pop(blob_sha, None)
+
+    def _url_path(self, url: str) -> str:
+        return os.path.join(self.url_dir, hashlib.sha256(url.encode("utf-8")).hexdigest() + ".json")
+
+    def lookup_url(self, url: str) -> Optional[Dict[str, str]]:
+        """Validators, blob SHA and MIME type stored for a URL, if its content is still in the store."""
+        try:
+            with open(self._url_path(url), "r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return entry if entry.get("url") == url and os.path.exists(self.path(entry["blob"])) else None
+
+    def remember_url(self, url: str, blob_sha: str, mime_type: str, etag: Optional[str], last_modified: Optional[str]):
+        entry = {"url": url, "blob": blob_sha, "mime": mime_type, "etag": etag, "last_modified": last_modified}
+        tmp_path = f"{self._url_path(url)}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, self._url_path(url))
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {**self._counts, "pinned": len(self._pins)}
+
+    def _evict(self, keep: str):
+        entries = []
+        for entry in os.scandir(self.store_dir):
+            if entry.is_file() and BLOB_SHA_RE.match(entry.name):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, blob_sha in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if blob_sha == keep or blob_sha in self._pins:
+                continue
+            try:
+                os.remove(self.path(blob_sha))
+            except OSError:
+                continue
+            total -= size
+
+attachment_store = AttachmentStore(config.ATTACHMENT_DIR, config.ATTACHMENT_STORE_MAX_BYTES)
+
+# === Streaming request ingestion ===
+# Base64 data URLs in a request are decoded while the body streams in and stored as files; the
+# request keeps a short reference in their place (see DataURLExtractor and fetch_attachment).
+STORED_ATTACHMENT_RE = re.compile(r"^data:([^;,]*);(stored|oversized|invalid),([0-9a-f]*)$")
+DATA_URL_HEAD_RE = re.compile(rb'^data:([^;,"\\]*)(?:;[^;,"\\]*)*;base64,')
+JSON_STRING_SPECIAL_RE = re.compile(rb'["\\]')
+NOT_BASE64 = bytes(byte for byte in range(256) if byte not in b"ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/")
+
+def stored_attachment_ids(request_data: BuildRequest) -> List[str]:
+    ids = []
+    for attachment in request_data.attachments or []:
+        match = STORED_ATTACHMENT_RE.match(attachment.url)
+        if match and match.group(2) == "stored":
+            ids.append(match.group(3))
+    return ids
+
+class DataURLExtractor:
+    """
+    Incremental filter over a JSON request body. Each attachment `"url"` that is a base64 data URL
+    is decoded chunk by chunk into the attachment store and replaced by a short
+    `data:<mime>;stored,<blob SHA>` reference (`;oversized,` past MAX_ATTACHMENT_SIZE, `;invalid,` if it
+    cannot be decoded). Everything else passes through unchanged, so neither the parsed request nor
+    the persisted job holds attachment data. Decoding stops once the body's attachments exceed
+    MAX_REQUEST_ATTACHMENT_BYTES (`over_limit`).
+    """
+    HEAD_LIMIT = 512  # a url value that is not recognised as a data URL by then passes through
+
+    def __init__(self):
+        self.stored: List[str] = []
+        self.over_limit = False
+        self._created: List[str] = []  # stored files this body added (not already in the store)
+        self._total = 0
+        self._out = bytearray()
+        self._state = "json"  # json, head (start of a url value), string, data
+        self._escaped = False
+        self._gap: Optional[bytearray] = None  # JSON since the last string ended, while it is short
+        self._string = bytearray()  # start of the current pass-through string
+        self._last_string = b""
+        self._head = bytearray()
+        self._mime = b""
+        self._target: Optional[IO[bytes]] = None
+        self._pending = bytearray()
+        self._size = 0
+        self._error: Optional[str] = None
+
+    def feed(self, chunk: bytes) -> bytes:
+        """Consume the next piece of the body; returns the rewritten JSON produced so far."""
+        i, end = 0, len(chunk)
+        while i < end:
+            if self._state == "json":
+                quote = chunk.find(b'"', i)
+                segment = chunk[i:] if quote < 0 else chunk[i:quote]
+                self._out += segment
+                if self._gap is not None:
+                    self._gap += segment
+                    if len(self._gap) > 64:
+                        self._gap = None
+                if quote < 0:
+                    break
+                i = quote + 1
+                is_url = self._last_string == b"url" and self._gap is not None and self._gap.strip() == b":"
+                self._state = "head" if is_url else "string"
+                self._head, self._string = bytearray(), bytearray()
+                if not is_url:
+                    self._out += b'"'
+                continue
+
+            if self._escaped:
+                # The byte after a backslash never ends the string
+                self._escaped = False
+                self._escaped_byte(chunk[i:i + 1])
+                i += 1
+                continue
+            match = JSON_STRING_SPECIAL_RE.search(chunk, i)
+            stop = match.start() if match else end
+            self._append(chunk[i:stop])
+            if not match:
+                break
+            i = stop + 1
+            if chunk[stop] == ord("\\"):
+                self._escaped = True
+                if self._state != "data":
+                    self._append(b"\\")
+            else:
+                self._close_string()
+
+        out, self._out = bytes(self._out), bytearray()
+        return out
+
+    def finish(self) -> bytes:
+        """End of body. A body cut off inside a string is passed on as is and fails JSON parsing."""
+        if self._state == "head":
+            self._out += b'"' + self._head
+        elif self._state == "data":
+            self._error = "truncated"
+            self._close_string()
+        out, self._out = bytes(self._out), bytearray()
+        return out
+
+    def discard(self):
+        """Release what was stored for this body (the request was rejected or is a duplicate)."""
+        if self._target is not None:
+            attachment_store.discard(self._target)
+            self._target = None
+        attachment_store.unpin(self.stored)
+        attachment_store.remove(self._created)
+        self.stored, self._created = [], []
+
+    def _append(self, data: bytes):
+        if not data:
+            return
+        if self._state == "string":
+            self._out += data
+            if len(self._string) < 16:
+                self._string += data[:16]
+        elif self._state == "head":
+            self._head += data
+            unescaped = bytes(self._head).replace(b"\\/", b"/")
+            match = DATA_URL_HEAD_RE.match(unescaped)
+            if match:
+                rest = unescaped[match.end():]
+                if self._escaped:
+                    rest = rest[:-1]  # the pending backslash is handled by the data state
+                self._start_data(match.group(1))
+                for part in re.split(rb"(\\.)", rest):
+                    if len(part) == 2 and part[:1] == b"\\":
+                        self._escaped_byte(part[1:])
+                    else:
+                        self._append(part)
+            elif len(self._head) > self.HEAD_LIMIT:
+                self._out += b'"' + self._head
+                self._state, self._string = "string", bytearray(b"-" * 16)
+        elif self._error is None:
+            self._pending += data.translate(None, NOT_BASE64)
+            if len(self._pending) >= 256 * 1024:
+                self._decode(len(self._pending) // 4 * 4)
+
+    def _escaped_byte(self, byte: bytes):
+        if self._state != "data":
+            self._append(byte)
+        elif byte == b"/":
+            self._append(byte)
+        elif byte not in (b"n", b"r", b"t"):
+            # Base64 never needs other escapes; \uXXXX and the like are not worth decoding
+            self._error = self._error or "invalid"
+
+    def _start_data(self, mime: bytes):
+        self._target = attachment_store.new_file()
+        self._state, self._mime = "data", mime
+        self._pending, self._size, self._error = bytearray(), 0, None
+
+    def _decode(self, length: int):
+        try:
+            data = base64.b64decode(bytes(self._pending[:length]))
+        except ValueError:
+            self._error = "invalid"
+            return
+        del self._pending[:length]
+        self._size += len(data)
+        self._total += len(data)
+        if self._total > config.MAX_REQUEST_ATTACHMENT_BYTES:
+            self.over_limit = True
+            self._error = "oversized"
+            return
+        if self._size > config.MAX_ATTACHMENT_SIZE:
+            self._error = "oversized"
+            return
+        self._target.write(data)
+
+    def _close_string(self):
+        if self._state == "head":
+            self._out += b'"' + self._head + b'"'
+        elif self._state == "string":
+            self._out += b'"'
+        else:
+            if self._error is None and self._pending:
+                self._pending += b"=" * (-len(self._pending) % 4)
+                self._decode(len(self._pending))
+            if self._error is None:
+                # Pinned until the job that references it has finished
+                blob_sha, created = attachment_store.add(self._target, pin=True)
+                self.stored.append(blob_sha)
+                if created:
+                    self._created.append(blob_sha)
+                reference = b"stored," + blob_sha.encode()
+            else:
+                attachment_store.discard(self._target)
+                reference = b"oversized," + str(self._size).encode() if self._error == "oversized" else b"invalid,"
+            self._target = None
+            self._out += b'"data:' + self._mime + b";" + reference + b'"'
+        self._last_string = bytes(self._string) if self._state == "string" else b""
+        self._state = "json"
+        self._gap = bytearray()
+
+# === Attachment fetching ===
+# One pooled client shared by all attachment downloads so keep-alive connections are reused.
+attachment_http = LoopBoundClient(
+    timeout=config.ATTACHMENT_TIMEOUT, follow_redirects=True,
+    limits=httpx.Limits(max_connections=config.ATTACHMENT_FETCH_CONCURRENCY * 4, max_keepalive_connections=config.ATTACHMENT_FETCH_CONCURRENCY),
+)
+
+def new_spool() -> IO[bytes]:
+    """Temp buffer that stays in memory up to ATTACHMENT_SPOOL_THRESHOLD bytes, then rolls over to disk."""
+    return tempfile.SpooledTemporaryFile(max_size=config.ATTACHMENT_SPOOL_THRESHOLD)
+
+def read_spool(spool: IO[bytes]) -> bytes:
+    spool.seek(0)
+    return spool.read()
+
+async def download_attachment(url: str, validators: Dict[str, str]) -> Optional[Tuple[str, str, Optional[str], Optional[str]]]:
+    """
+    Stream a URL into the attachment store, size-capped and with its own deadline.
+    Returns (blob SHA, mime type, ETag, Last-Modified), or None if the validators still match (304).
+    """
+    limit = config.MAX_ATTACHMENT_SIZE
+    target = attachment_store.new_file()
+    try:
+        async with asyncio.timeout(config.ATTACHMENT_TIMEOUT):
+            async with attachment_http.get().stream("GET", url, headers=validators) as response:
+                if response.status_code == 304 and validators:
+                    attachment_store.discard(target)
+                    return None
+                response.raise_for_status()
+                if response.status_code != 200:
+                    raise ValueError(f"Unexpected status {response.status_code} for attachment download")
+                content_length = response.headers.get("Content-Length")
+                if content_length and content_length.isdigit() and int(content_length) > limit:
+                    raise ValueError(f"Attachment Content-Length {content_length} exceeds MAX_ATTACHMENT_SIZE ({limit} bytes)")
+
+                size = 0
+                async for chunk in response.aiter_bytes(64 * 1024):
+                    size += len(chunk)
+                    if size > limit:
+                        raise ValueError(f"Attachment exceeds MAX_ATTACHMENT_SIZE ({limit} bytes)")
+                    target.write(chunk)
+                mime_type = response.headers.get("Content-Type", "application/octet-stream").split(";")[0].strip()
+                etag, last_modified = response.headers.get("ETag"), response.headers.get("Last-Modified")
+    except TimeoutError:
+        attachment_store.discard(target)
+        raise TimeoutError(f"Download exceeded {config.ATTACHMENT_TIMEOUT}s deadline")
+    except BaseException:
+        attachment_store.discard(target)
+        raise
+    return attachment_store.add(target)[0], mime_type, etag, last_modified
+
+async def fetch_attachment(attachment: Attachment) -> Optional[Tuple[IO[bytes], str]]:
+    """
+    Resolve a single attachment to (content, mime type).
+    Supports both Base64 data URLs and direct HTTP URLs; returns None for unsupported URLs.
+    Stored data URLs and downloads are files in the attachment store.
+    Raises ValueError as soon as the content is known to exceed MAX_ATTACHMENT_SIZE.
+    """
+    limit = config.MAX_ATTACHMENT_SIZE
+    stored = STORED_ATTACHMENT_RE.match(attachment.url)
+    if stored:
+        # Decoded while the request was received; the file is opened, not copied
+        mime_type, status, value = stored.groups()
+        if status == "oversized":
+            raise ValueError(f"Attachment exceeds MAX_ATTACHMENT_SIZE ({limit} bytes)")
+        if status == "invalid":
+            raise ValueError("Attachment data URL is not valid base64")
+        content = attachment_store.open(value)
+        if content is None:
+            raise ValueError("Stored attachment is no longer available")
+        return content, mime_type
+
+    if attachment.url.startswith("data:"):
+        # Handle Base64 encoded data
+        header, encoded = attachment.url.split(",", 1)
+        mime_type = header.split(";")[0].split(":")[1]
+        if len(encoded) * 3 // 4 > limit:
+            raise ValueError(f"Attachment exceeds MAX_ATTACHMENT_SIZE ({limit} bytes)")
+        spool = new_spool()
+        spool.write(base64.b64decode(encoded))
+        return spool, mime_type
+
+    if attachment.url.startswith("http"):
+        # Downloaded once into the attachment store; a repeat is revalidated with a conditional GET
+        print(f"Downloading attachment from URL: {attachment.url}")
+        known = attachment_store.lookup_url(attachment.url)
+        validators = {}
+        if known and known.get("etag"):
+            validators["If-None-Match"] = known["etag"]
+        if known and known.get("last_modified"):
+            validators["If-Modified-Since"] = known["last_modified"]
+        download = await download_attachment(attachment.url, validators)
+        if download is None:
+            content = attachment_store.open(known["blob"])
+            if content is not None:
+                attachment_store.count("revalidated")
+                metrics.inc("attachment_fetches_total", result="not_modified")
+                return content, known["mime"]
+            # Evicted since the lookup
+            download = await download_attachment(attachment.url, {})
+        blob_sha, mime_type, etag, last_modified = download
+        if etag or last_modified:
+            attachment_store.remember_url(attachment.url, blob_sha, mime_type, etag, last_modified)
+        attachment_store.count("downloaded")
+        metrics.inc("attachment_fetches_total", result="downloaded")
+        return attachment_store.open(blob_sha), mime_type
+
+    print(f"Unsupported attachment URL format: {attachment.url}")
+    return None
+
+async def resolve_attachments(attachments: List[Attachment]) -> List[Tuple[Attachment, IO[bytes], str]]:
+    """
+    Fetch all attachments concurrently (bounded by ATTACHMENT_FETCH_CONCURRENCY).
+    Results keep the request order; failed or unsupported attachments are logged and dropped.
+    """
+    if not attachments:
+        return []
+
+    semaphore = asyncio.Semaphore(config.ATTACHMENT_FETCH_CONCURRENCY)
+
+    async def fetch(attachment: Attachment):
+        async with semaphore:
+            return await fetch_attachment(attachment)
+
+    results = await asyncio.gather(*(fetch(attachment) for attachment in attachments), return_exceptions=True)
+
+    resolved = []
+    for attachment, result in zip(attachments, results):
+        if isinstance(result, Exception):
+            print(f"Warning: Could not fetch attachment '{attachment.name}'. Error: {result}")
+            continue
+        if result is not None:
+            resolved.append((attachment, *result))
+    return resolved
+
+# === LLM generation cache ===
+class GenerationCache:
+    """
+    Content-addressed cache of parsed LLM generations, keyed by a hash of the model and final prompt.
+    An in-memory LRU sits in front of a directory of JSON files that is evicted oldest-first by total size.
+    """
+
+    def __init__(self, cache_dir: str, memory_items: int, max_bytes: int):
+        self.cache_dir = cache_dir
+        self.memory_items = memory_items
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._memory: "OrderedDict[str, Dict[str, str]]" = OrderedDict()
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(model: str, prompt: str) -> str:
+        return hashlib.sha256(f"{model}\0{prompt}".encode("utf-8")).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def get(self, key: str) -> Optional[Dict[str, str]]:
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return self._memory[key]
+            try:
+                with open(self._path(key), "r", encoding="utf-8") as f:
+                    files = json.load(f)
+                os.utime(self._path(key))  # Mark as recently used for disk eviction
+            except (OSError, ValueError):
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._remember(key, files)
+            return files
+
+    def put(self, key: str, files: Dict[str, str]):
+        with self._lock:
+            self._remember(key, files)
+            tmp_path = f"{self._path(key)}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(files, f)
+            os.replace(tmp_path, self._path(key))
+            self._evict_disk()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "memory_entries": len(self._memory)}
+
+    def _remember(self, key: str, files: Dict[str, str]):
+        self._memory[key] = files
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_items:
+            self._memory.popitem(last=False)
+
+    def _evict_disk(self):
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith(".json"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+
+generation_cache = GenerationCache(config.LLM_CACHE_DIR, config.LLM_CACHE_MEMORY_ITEMS, config.LLM_CACHE_MAX_BYTES)
+
+# === Streaming LLM output ===
+class StreamingFileMapParser:
+    """
+    Incremental parser for the LLM's flat JSON file map ({"filename": "content", ...}).
+    feed() returns the (filename, content) pairs completed by the new text, so each file can be handed
+    on while the rest of the completion is still streaming. Text before the first '{' (such as a
+    ```json fence) is ignored, and files completed before a cut-off stay available in `files`.
+    """
+
+    def __init__(self):
+        self.files: Dict[str, str] = {}
+        self.complete = False
+        self._buffer = ""
+        self._pos = 0  # Start of the token being parsed
+        self._scan = 0  # Resume point while scanning a long token
+        self._state = "start"
+        self._key: Optional[str] = None
+
+    def feed(self, text: str) -> List[Tuple[str, str]]:
+        self._buffer += text
+        completed = []
+        while not self.complete:
+            item = self._step()
+            if item is False:
+                break
+            if item is not None:
+                completed.append(item)
+        # Drop consumed text so memory stays proportional to the file being streamed
+        self._buffer = self._buffer[self._pos:]
+        self._scan -= self._pos
+        self._pos = 0
+        return completed
+
+    def _skip_whitespace(self) -> bool:
+        while self._pos < len(self._buffer) and self._buffer[self._pos] in " \t\r\n":
+            self._pos += 1
+        return self._pos < len(self._buffer)
+
+    def _string_end(self) -> Optional[int]:
+        """Index of the closing quote of the string starting at _pos, or None if it is not complete yet."""
+        i = max(self._scan, self._pos + 1)
+        while i < len(self._buffer):
+            char = self._buffer[i]
+            if char == "\\":
+                if i + 1 >= len(self._buffer):
+                    break
+                i += 2
+                continue
+            if char == '"':
+                self._scan = 0
+                return i
+            i += 1
+        self._scan = i
+        return None
+
+    def _value_end(self) -> Optional[int]:
+        """End index of a non-string value (nested object, number, ...) starting at _pos."""
+        depth, in_string, i = 0, False, self._pos
+        while i < len(self._buffer):
+            char = self._buffer[i]
+            if in_string:
+                if char == "\\":
+                    i += 1
+                elif char == '"':
+                    in_string = False
+            elif char == '"':
+                in_string = True
+            elif char in "{[":
+                depth += 1
+            elif char in "}]":
+                if depth == 0:
+                    return i
+                depth -= 1
+            elif char == "," and depth == 0:
+                return i
+            i += 1
+        return None
+
+    def _step(self):
+        """Advance one token. Returns a completed (filename, content), None to continue, or False for more input."""
+        if self._state == "start":
+            start = self._buffer.find("{", self._pos)
+            if start < 0:
+                self._pos = len(self._buffer)
+                return False
+            self._pos, self._state = start + 1, "key"
+            return None
+
+        if not self._skip_whitespace():
+            return False
+        char = self._buffer[self._pos]
+
+        if self._state == "key":
+            if char == "}":
+                self._pos += 1
+                self.complete = True
+                return None
+            if char == ",":
+                self._pos += 1
+                return None
+            if char != '"':
+                raise ValueError(f"Unexpected character {char!r} in file map")
+            end = self._string_end()
+            if end is None:
+                return False
+            self._key = json.loads(self._buffer[self._pos:end + 1])
+            self._pos, self._state = end + 1, "colon"
+            return None
+
+        if self._state == "colon":
+            if char != ":":
+                raise ValueError(f"Expected ':' after key {self._key!r}")
+            self._pos, self._state = self._pos + 1, "value"
+            return None
+
+        # self._state == "value"
+        if char == '"':
+            end = self._string_end()
+            if end is None:
+                return False
+            content = json.loads(self._buffer[self._pos:end + 1])
+            self._pos = end + 1
+        else:
+            end = self._value_end()
+            if end is None:
+                return False
+            value = json.loads(self._buffer[self._pos:end])
+            content = value if isinstance(value, str) else json.dumps(value, indent=2)
+            self._pos = end
+        self.files[self._key] = content
+        self._state = "key"
+        return self._key, content
+
+def record_llm_usage(model: str, usage, prompt: str, completion_chars: int):
+    """Count tokens from the API's usage report, or estimate them when the provider sends none."""
+    if usage is not None and getattr(usage, "prompt_tokens", None) is not None:
+        prompt_tokens, completion_tokens = usage.prompt_tokens, usage.completion_tokens or 0
+    else:
+        prompt_tokens, completion_tokens = count_tokens(prompt, model), completion_chars // 4
+    metrics.inc("llm_prompt_tokens_total", prompt_tokens, model=model)
+    metrics.inc("llm_completion_tokens_total", completion_tokens, model=model)
+
+async def stream_file_map(client: "AsyncOpenAI", model: str, prompt: str, on_file: Callable[[str, str], None]) -> StreamingFileMapParser:
+    """
+    Stream the completion and parse the file map incrementally, calling on_file for each completed file.
+    If the stream is cut off, including by the LLM_TIMEOUT deadline, the parser still holds every file
+    completed so far.
+    """
+    parser = StreamingFileMapParser()
+    usage = None
+    completion_chars = 0
+    try:
+        # The deadline is handled here, not by the caller, so a timeout keeps the completed files
+        async with asyncio.timeout(config.LLM_TIMEOUT):
+            stream = await client.chat.completions.create(
+                model=model,
+                messages=[{"role": "user", "content": prompt}],
+                temperature=0.1,
+                timeout=config.LLM_TIMEOUT,
+                # IMPORTANT: Request JSON output
+                response_format={"type": "json_object"},
+                stream=True,
+                stream_options={"include_usage": True},
+            )
+            try:
+                async for chunk in stream:
+                    # With include_usage the last chunk carries the token counts and no choices
+                    usage = getattr(chunk, "usage", None) or usage
+                    if not chunk.choices or not chunk.choices[0].delta.content:
+                        continue
+                    completion_chars += len(chunk.choices[0].delta.content)
+                    for filename, content in parser.feed(chunk.choices[0].delta.content):
+                        print(f"LLM finished file: {filename} ({len(content)} chars, {model})")
+                        on_file(filename, content)
+            finally:
+                # A cancelled (losing) hedge must release its connection right away
+                await stream.close()
+    except Exception as e:
+        if not parser.files:
+            raise
+        print(f"LLM stream from {model} interrupted after {len(parser.files)} complete file(s): {e!r}")
+    finally:
+        record_llm_usage(model, usage, prompt, completion_chars)
+    return parser
+
+# === Prompt token budget ===
+# Context windows of the models we route to; anything else gets DEFAULT_CONTEXT_TOKENS
+MODEL_CONTEXT_TOKENS = {
+    "openai/gpt-4o": 128000,
+    "openai/gpt-4o-mini": 128000,
+    "openai/gpt-4.1": 1047576,
+    "openai/gpt-4.1-mini": 1047576,
+    "anthropic/claude-3.5-sonnet": 200000,
+    "google/gemini-2.0-flash-001": 1048576,
+}
+DEFAULT_CONTEXT_TOKENS = 32000
+ENCODER_RETRY_SECONDS = 300
+_token_encoders: Dict[str, object] = {}
+_token_encoder_loads: Dict[str, float] = {}  # model -> when loading its encoder was last started
+
+def load_token_encoder(model: str) -> bool:
+    """
+    Load the tiktoken encoding for model; blocking, since the first load downloads it. Returns False if
+    tiktoken is not installed. A failed download raises and is retried later, not remembered.
+    """
+    tiktoken = lazy_import("tiktoken", optional=True)
+    if tiktoken is None:
+        return False
+    try:
+        encoder = tiktoken.encoding_for_model(model.split("/")[-1])
+    except KeyError:
+        # Not a model tiktoken knows
+        encoder = tiktoken.get_encoding("cl100k_base")
+    _token_encoders[model] = encoder
+    return True
+
+def _load_token_encoder_in_background(model: str):
+    try:
+        load_token_encoder(model)
+    except Exception as e:
+        print(f"Warning: Could not load the tiktoken encoding for {model}, estimating tokens: {e}")
+
+def count_tokens(text: str, model: str) -> int:
+    """
+    Token count with the model's tiktoken encoding once it is loaded, otherwise a ~4 characters per token
+    estimate. Loading is started in a worker thread, so the event loop never waits for the download.
+    """
+    encoder = _token_encoders.get(model)
+    if encoder is not None:
+        return len(encoder.encode(text, disallowed_special=()))
+    last_load = _token_encoder_loads.get(model)
+    if last_load is None or time.monotonic() - last_load > ENCODER_RETRY_SECONDS:
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+        if loop is not None:
+            _token_encoder_loads[model] = time.monotonic()
+            loop.run_in_executor(None, _load_token_encoder_in_background, model)
+    return len(text) // 4 + 1
+
+class PromptBudget:
+    """Running token count of one prompt against the budget for its model."""
+
+    def __init__(self, model: str):
+        self.model = model
+        context = MODEL_CONTEXT_TOKENS.get(model, DEFAULT_CONTEXT_TOKENS)
+        self.limit = min(config.PROMPT_TOKEN_BUDGET, context - config.LLM_COMPLETION_RESERVE)
+        self.used = 0
+
+    def take(self, text: str) -> str:
+        self.used += count_tokens(text, self.model)
+        return text
+
+    def try_take(self, text: str) -> bool:
+        tokens = count_tokens(text, self.model)
+        if self.used + tokens > self.limit:
+            return False
+        self.used += tokens
+        return True
+
+def csv_value_type(value: str) -> str:
+    if not value.strip():
+        return "empty"
+    for kind, parse in (("int", int), ("float", float)):
+        try:
+            parse(value)
+            return kind
+        except ValueError:
+            pass
+    return "string"
+
+def summarize_csv(text: str, sample_rows: int = 5) -> str:
+    reader = csv.reader(io.StringIO(text))
+    header = next(reader, [])
+    column_types = [set() for _ in header]
+    samples: List[List[str]] = []
+    row_count = 0
+    for row in reader:
+        row_count += 1
+        if row_count <= 100:
+            for i, value in enumerate(row[:len(header)]):
+                column_types[i].add(csv_value_type(value))
+        if len(samples) < sample_rows:
+            samples.append(row)
+    columns = ", ".join(
+        f"{name} ({'/'.join(sorted(types - {'empty'})) or 'empty'})" for name, types in zip(header, column_types)
+    )
+    sample_text = "\n".join(",".join(row) for row in [header] + samples)
+    return (
+        f"CSV with {row_count} data rows and {len(header)} columns: {columns}\n"
+        f"First {len(samples)} rows:\n```\n{sample_text}\n```"
+    )
+
+def json_schema(value, depth: int = 0):
+    """Shape of a JSON value: keys and element types, without the data."""
+    if isinstance(value, dict):
+        if depth >= 3:
+            return "object"
+        return {key: json_schema(item, depth + 1) for key, item in list(value.items())[:30]}
+    if isinstance(value, list):
+        return [json_schema(value[0], depth + 1)] if value else []
+    if isinstance(value, bool):
+        return "boolean"
+    if isinstance(value, (int, float)):
+        return "number"
+    return "null" if value is None else "string"
+
+def summarize_json(text: str) -> str:
+    data = json.loads(text)
+    if isinstance(data, list):
+        shape, sample = f"JSON array with {len(data)} items", data[:3]
+    elif isinstance(data, dict):
+        shape, sample = f"JSON object with {len(data)} keys", {key: data[key] for key in list(data)[:5]}
+    else:
+        shape, sample = "JSON scalar", data
+    sample_text = json.dumps(sample)[:2000]
+    return (
+        f"{shape}. Schema:\n```json\n{json.dumps(json_schema(data), indent=1)}\n```\n"
+        f"Sample:\n```json\n{sample_text}\n```"
+    )
+
+def summarize_text_file(name: str, text: str) -> str:
+    """Structured summary of a large file: schema, counts and a sample for CSV/JSON, the head otherwise."""
+    lowered = name.lower()
+    try:
+        if lowered.endswith(".csv"):
+            return summarize_csv(text)
+        if lowered.endswith(".json"):
+            return summarize_json(text)
+    except (ValueError, csv.Error):
+        pass
+    lines = text.splitlines()
+    head = "\n".join(lines[:40])[:4000]
+    return f"Text file with {len(lines)} lines. First lines:\n```\n{head}\n```"
+
+def budgeted_file_section(title: str, name: str, text: str, max_inline_chars: int, budget: PromptBudget, large_note: str) -> str:
+    """
+    Prompt section for a text file: the full text if it is small and fits the remaining budget,
+    otherwise a structured summary, otherwise only a one-line mention.
+    """
+    if len(text) <= max_inline_chars:
+        full = f"\n\n--- {title} ---\n```\n{text}\n```"
+        if budget.try_take(full):
+            return full
+    summary = f"\n\n--- {title} (summary; {large_note}) ---\n{summarize_text_file(name, text)}"
+    if budget.try_take(summary):
+        return summary
+    return budget.take(f"\n\n--- {title} ({len(text)} characters; {large_note}) ---")
+
+# === Revision context and patch edits ===
+PATCH_SEARCH = "<<<<<<< SEARCH"
+PATCH_DIVIDER = "======="
+PATCH_REPLACE = ">>>>>>> REPLACE"
+PATCH_BLOCK_RE = re.compile(r"<<<<<<< SEARCH\n(.*?)\n?=======\n(.*?)\n?>>>>>>> REPLACE", re.DOTALL)
+MANAGED_FILES = ("README.md", "LICENSE")
+
+REVISION_EDIT_INSTRUCTIONS = f"""
+**HOW TO CHANGE EXISTING FILES:**
+- Only include files you create or change; files you leave out stay exactly as they are.
+- For a new file, or a file you rewrite completely, the value is its full content.
+- For a small change to an existing file, the value may instead be one or more patch blocks:
+{PATCH_SEARCH}
+exact lines copied from the current file
+{PATCH_DIVIDER}
+the replacement lines
+{PATCH_REPLACE}
+- Every SEARCH section must match the current file exactly and should be just long enough to be unique.
+"""
+
+async def load_repo_snapshot(repo: Dict) -> Tuple[Dict[str, str], Dict[str, int]]:
+    """
+    Fetch the whole default branch as a single tarball (one API call).
+    Returns ({path: text} for UTF-8 files, {path: size} for binary or oversized files).
+    """
+    spool = new_spool()
+    await github.download(f"/repos/{repo['full_name']}/tarball/{repo['default_branch']}", spool)
+    spool.seek(0)
+    # Unpacking is CPU-bound; keep it off the event loop
+    return await asyncio.to_thread(read_snapshot_archive, spool)
+
+def read_snapshot_archive(spool: IO[bytes]) -> Tuple[Dict[str, str], Dict[str, int]]:
+    text_files: Dict[str, str] = {}
+    other_files: Dict[str, int] = {}
+    with tarfile.open(fileobj=spool, mode="r:*") as archive:
+        for member in archive:
+            if not member.isfile():
+                continue
+            # Archive entries are prefixed with an "<owner>-<repo>-<sha>/" directory
+            path = member.name.split("/", 1)[1] if "/" in member.name else member.name
+            add_snapshot_file(text_files, other_files, path, member.size, lambda: archive.extractfile(member).read())
+    return text_files, other_files
+
+def add_snapshot_file(text_files: Dict[str, str], other_files: Dict[str, int], path: str, size: int, read: Callable[[], bytes]):
+    """Sort one repository file into the text files (UTF-8, within the size limit) or the other files."""
+    if size > config.MAX_ATTACHMENT_SIZE:
+        other_files[path] = size
+        return
+    try:
+        text_files[path] = read().decode("utf-8")
+    except UnicodeDecodeError:
+        other_files[path] = size
+
+def format_repo_context(text_files: Dict[str, str], other_files: Dict[str, int], budget: PromptBudget) -> str:
+    """
+    Compact prompt view of the repository: a file listing, the editable text files (within the token
+    budget, larger ones summarized), and edit instructions.
+    """
+    sizes = {path: len(text.encode("utf-8")) for path, text in text_files.items()}
+    sizes.update(other_files)
+    context = "**EXISTING REPOSITORY FILES:**\n"
+    context += "".join(f"- `{path}` ({size} bytes)\n" for path, size in sorted(sizes.items()))
+
+    budget.take(context + REVISION_EDIT_INSTRUCTIONS)
+
+    # Pages and code first: they are what the model edits; data files are the first to be summarized
+    editable = [path for path in text_files if path not in MANAGED_FILES and not path.endswith(".b64")]
+    editable.sort(key=lambda path: (not path.endswith((".html", ".css", ".js")), path))
+    for path in editable:
+        context += budgeted_file_section(
+            f"`{path}`", path, text_files[path], config.REVISION_INLINE_CHARS, budget, "too large to show in full, do not patch it"
+        )
+    return context + "\n" + REVISION_EDIT_INSTRUCTIONS
+
+def apply_search_replace(original: str, patch: str) -> str:
+    """Apply SEARCH/REPLACE blocks in order; raises ValueError if a block does not match the file."""
+    blocks = PATCH_BLOCK_RE.findall(patch)
+    if not blocks:
+        raise ValueError("no valid SEARCH/REPLACE blocks")
+    text = original
+    for search, replace in blocks:
+        if not search:
+            text = text.rstrip("\n") + "\n" + replace + "\n"
+        elif not replace and search + "\n" in text:
+            # An empty REPLACE deletes the lines, including their line break
+            text = text.replace(search + "\n", "", 1)
+        elif search in text:
+            text = text.replace(search, replace, 1)
+        else:
+            # Tolerate trailing-whitespace differences by matching line by line
+            lines = text.split("\n")
+            search_lines = [line.rstrip() for line in search.split("\n")]
+            for i in range(len(lines) - len(search_lines) + 1):
+                if [line.rstrip() for line in lines[i:i + len(search_lines)]] == search_lines:
+                    lines[i:i + len(search_lines)] = replace.split("\n") if replace else []
+                    break
+            else:
+                raise ValueError(f"SEARCH block not found: {search[:60]!r}")
+            text = "\n".join(lines)
+    return text
+
+def apply_file_edit(filename: str, content: str, existing_files: Dict[str, str]) -> Optional[str]:
+    """Return the final content for a generated file, applying it as a patch if it is one (None to skip)."""
+    if not content.lstrip().startswith(PATCH_SEARCH):
+        return content
+    if filename not in existing_files:
+        print(f"Warning: Patch for unknown file {filename} ignored.")
+        return None
+    try:
+        return apply_search_replace(existing_files[filename], content)
+    except ValueError as e:
+        print(f"Warning: Could not apply patch to {filename}, keeping the current version: {e}")
+        return None
+
 # === LLM / attachment handling ===
-def generate_code_from_brief(request_data: BuildRequest, existing_code: str = None) -> Tuple[Dict[str, str], Dict[str, bytes]]:
+async def generate_code_from_brief(
+    request_data: BuildRequest,
+    existing_files: Optional[Dict[str, str]] = None,
+    on_file: Optional[Callable[[str, str], None]] = None,
+    other_files: Optional[Dict[str, int]] = None,
+) -> Tuple[Dict[str, str], Dict[str, IO[bytes]]]:
+    """
+    Generate the file map for a brief. For revisions, existing_files/other_files describe the current
+    repository (see load_repo_snapshot) and the model may answer with patches, which are applied here.
+    on_file, if given, is called with each final file as soon as it is complete (while streaming),
+    so the deploy stage can start uploading before generation finishes.
+    """
+    on_file = on_file or (lambda filename, content: None)
     if not config.AIPIPE_TOKEN:
         raise HTTPException(status_code=503, detail="Server configuration error: AIPIPE_TOKEN is not set.")
 
-    client = OpenAI(base_url="https://aipipe.org/openrouter/v1", api_key=config.AIPIPE_TOKEN)
-    attachments_content = ""
-    binary_files_to_commit: Dict[str, bytes] = {}
+    # Text attachments are kept as (name, text) and rendered against the token budget below
+    attachment_sections: List[Union[str, Tuple[str, str]]] = []
+    binary_files_to_commit: Dict[str, IO[bytes]] = {}
 
     # === Attachment handling ===
-    if request_data.attachments:
-        for attachment in request_data.attachments:
-            try:
-                # --- NEW: Supports both Base64 data URLs and direct HTTP URLs ---
+    # Oversized attachments are already dropped while streaming (MAX_ATTACHMENT_SIZE)
+    with metrics.span("attachments"):
+        resolved_attachments = await resolve_attachments(request_data.attachments or [])
+    for attachment, spool, mime_type in resolved_attachments:
+        try:
+            # Handle image attachments
+            if mime_type.startswith("image/"):
+                safe_filename = sanitize_filename(attachment.name)
+                binary_files_to_commit[safe_filename] = spool
+
                 if attachment.url.startswith("data:"):
-                    # Handle Base64 encoded data
-                    header, encoded = attachment.url.split(",", 1)
-                    mime_type = header.split(";")[0].split(":")[1]
-                    decoded_bytes = base64.b64decode(encoded)
-                elif attachment.url.startswith("http"):
-                    # Handle downloadable files
-                    print(f"Downloading attachment from URL: {attachment.url}")
-                    response = requests.get(attachment.url, timeout=30)
-                    response.raise_for_status()
-                    decoded_bytes = response.content
-                    mime_type = response.headers.get("Content-Type", "application/octet-stream")
+                    # Inline images are committed as real files that Pages serves; never paste them into the prompt
+                    attachment_sections.append(
+                        f"\n\n--- Attachment: `{safe_filename}` (Image file) ---\n"
+                        f"Provided inline; it is committed to the repository root as `{safe_filename}`.\n"
+                        f"IMPORTANT: Use the relative path `{safe_filename}` as the default/fallback image in your generated code.\n"
+                    )
                 else:
-                    print(f"Unsupported attachment URL format: {attachment.url}")
-                    continue
-
-                # Size limit guard
-                if len(decoded_bytes) > config.MAX_ATTACHMENT_SIZE:
-                    print(f"Attachment {attachment.name} too large. Skipping.")
-                    continue
-
-                # Handle image attachments
-                if mime_type.startswith("image/"):
-                    safe_filename = sanitize_filename(attachment.name)
-                    binary_files_to_commit[safe_filename] = decoded_bytes
-
-                    attachments_content += f"\n\n--- Attachment: `{safe_filename}` (Image file) ---\n"
-                    attachments_content += f"Original URL: {attachment.url}\n"
-                    attachments_content += (
+                    attachment_sections.append(
+                        f"\n\n--- Attachment: `{safe_filename}` (Image file) ---\n"
+                        f"Original URL: {attachment.url}\n"
                         "IMPORTANT: Use this URL as the default/fallback image in your generated code.\n"
                     )
 
-                # Handle text-like attachments
-                elif mime_type.startswith("text/") or mime_type in (
-                    "application/json",
-                    "application/javascript",
-                ):
-                    try:
-                        text_content = decoded_bytes.decode('utf-8', errors='ignore')
-                        attachments_content += (
-                            f"\n\n--- Attachment: `{attachment.name}` ---\n```\n"
-                            f"{text_content}\n```"
-                        )
-                        # CRITICAL: Save text attachments as real files
-                        safe_filename = sanitize_filename(attachment.name)
-                        binary_files_to_commit[safe_filename] = decoded_bytes
-                    except Exception:
-                        attachments_content += (
-                            f"\n\n--- Attachment: `{attachment.name}` (text decode failed) ---"
-                        )
-
-                # Handle other binary files
-                else:
+            # Handle text-like attachments
+            elif mime_type.startswith("text/") or mime_type in (
+                "application/json",
+                "application/javascript",
+            ):
+                try:
+                    text_content = read_spool(spool).decode('utf-8', errors='ignore')
+                    attachment_sections.append((attachment.name, text_content))
+                    # CRITICAL: Save text attachments as real files
                     safe_filename = sanitize_filename(attachment.name)
-                    binary_files_to_commit[safe_filename] = decoded_bytes
-                    attachments_content += (
-                        f"\n\n--- Attachment: `{safe_filename}` (Binary file saved to repo) ---"
+                    binary_files_to_commit[safe_filename] = spool
+                except Exception:
+                    attachment_sections.append(
+                        f"\n\n--- Attachment: `{attachment.name}` (text decode failed) ---"
                     )
 
-            except Exception as e:
-                print(f"Warning: Could not process attachment '{attachment.name}'. Error: {e}")
-                traceback.print_exc()
+            # Handle other binary files
+            else:
+                safe_filename = sanitize_filename(attachment.name)
+                binary_files_to_commit[safe_filename] = spool
+                attachment_sections.append(
+                    f"\n\n--- Attachment: `{safe_filename}` (Binary file saved to repo) ---"
+                )
+
+        except Exception as e:
+            print(f"Warning: Could not process attachment '{attachment.name}'. Error: {e}")
+            traceback.print_exc()
 
     # === Build technical requirement text ===
     technical_requirements = ""
@@ -146,23 +1399,32 @@ def generate_code_from_brief(request_data: BuildRequest, existing_code: str = No
 
     # === Define generation action ===
     action = (
-        "modify an existing HTML file"
-        if existing_code
+        "modify the existing repository files"
+        if existing_files
         else "create a new, self-contained `index.html` file"
     )
-    existing_code_section = (
-        f"**EXISTING CODE:**\n```html\n{existing_code}\n```" if existing_code else ""
-    )
+    # === Output format: revisions may omit unchanged files and answer with patches ===
+    if existing_files:
+        task_line = "Your task is to make the changes the user's brief asks for to the existing repository."
+        output_format = (
+            "The values are the full content of each new or rewritten file, or SEARCH/REPLACE patch blocks "
+            "for an existing file (see HOW TO CHANGE EXISTING FILES). Leave out files that do not change."
+        )
+        generation_rule = "Create or change every file the brief asks for (.txt, .json, .md, .svg, .html, ...); leave out files that stay the same."
+    else:
+        task_line = "Your task is to generate the complete content for all files requested in the user's brief."
+        output_format = "The values must be the complete, raw string content for each file."
+        generation_rule = "Generate ALL files requested in the brief, including .txt, .json, .md, .svg, and .html."
 
     # === Final prompt template ===
     prompt_template = """
-You are an elite software engineer. Your task is to generate the complete content for all files requested in the user's brief.
+You are an elite software engineer. {task_line}
 
 Analyze the user's brief, attachments, and technical requirements.
 
 Your output MUST be a single, valid JSON object.
 The keys of the JSON object must be the full filenames (e.g., "index.html", "data.json", "style.css").
-The values must be the complete, raw string content for each file.
+{output_format}
 
 Do not include any explanations, comments, or markdown outside of the final JSON object.
 For external libraries in HTML, use public CDNs.
@@ -183,150 +1445,934 @@ For external libraries in HTML, use public CDNs.
 - If ?url= parameter is present, fetch from that URL; otherwise fetch from the local file in the repo root
 
 **CRITICAL INSTRUCTIONS FOR FILE GENERATION:**
-- Generate ALL files requested in the brief, including .txt, .json, .md, .svg, and .html.
+- {generation_rule}
 - The 'index.html' file should link to all other files you generate.
 - DO NOT generate a 'README.md' or 'LICENSE' file. They will be added automatically.
 
 {tech_reqs}
 """
 
+    # === Token-budgeted assembly: fixed parts first, then repository files, then text attachments ===
+    budget = PromptBudget(config.LLM_MODEL)
+    budget.take(prompt_template + task_line + output_format + generation_rule + request_data.brief + technical_requirements)
+    budget.take("".join(section for section in attachment_sections if isinstance(section, str)))
+    existing_code_section = (
+        format_repo_context(existing_files, other_files or {}, budget) if existing_files else ""
+    )
+    attachments_content = "".join(
+        section if isinstance(section, str) else budgeted_file_section(
+            f"Attachment: `{section[0]}`", section[0], section[1], config.ATTACHMENT_INLINE_CHARS, budget,
+            f"the full file is committed to the repository as `{sanitize_filename(section[0])}`",
+        )
+        for section in attachment_sections
+    )
+    print(f"Prompt for '{request_data.task}': ~{budget.used} tokens (budget {budget.limit}).")
+
     final_prompt = prompt_template.format(
         action=action,
+        task_line=task_line,
+        output_format=output_format,
+        generation_rule=generation_rule,
         existing_code_section=existing_code_section,
         brief=request_data.brief,
         attachments=attachments_content,
         tech_reqs=technical_requirements,
     )
 
-    # === LLM call ===
-    try:
-        completion = client.chat.completions.create(
-            model=config.LLM_MODEL,
-            messages=[{"role": "user", "content": final_prompt}],
+    # Revision rounds may answer with SEARCH/REPLACE patches; resolve them as each file arrives
+    resolved: Dict[Tuple[str, str], Optional[str]] = {}
+
+    def resolve(filename: str, content: str) -> Optional[str]:
+        if (filename, content) not in resolved:
+            resolved[filename, content] = apply_file_edit(filename, content, existing_files or {})
+        return resolved[filename, content]
+
+    def emit(filename: str, content: str):
+        content = resolve(filename, content)
+        if content is not None:
+            on_file(filename, content)
+
+    with metrics.span("llm"):
+        file_map = await request_file_map(request_data.task, final_prompt, emit)
+    # A hedged attempt that lost may have streamed files too; only the winning map is deployed
+    resolved_files = {filename: resolve(filename, content) for filename, content in file_map.items()}
+    return {filename: content for filename, content in resolved_files.items() if content is not None}, binary_files_to_commit
+
+# Pooled connections to the LLM endpoint, shared by every job
+llm_http = LoopBoundClient(timeout=httpx.Timeout(config.LLM_TIMEOUT, connect=10.0), limits=httpx.Limits(max_connections=None, max_keepalive_connections=100))
+
+class LLMLatencyTracker:
+    """
+    Wall times of recent successful generations. The configured percentile of them is how long
+    an attempt may run before a hedge is started; until enough samples exist LLM_HEDGE_DELAY is used.
+    """
+
+    MIN_SAMPLES = 20
+
+    def __init__(self, window: int = 200):
+        self.samples: deque = deque(maxlen=window)
+
+    def record(self, seconds: float):
+        self.samples.append(seconds)
+
+    def hedge_delay(self) -> float:
+        if len(self.samples) < self.MIN_SAMPLES:
+            return config.LLM_HEDGE_DELAY
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(config.LLM_HEDGE_PERCENTILE * len(ordered)))]
+
+llm_latency = LLMLatencyTracker()
+
+async def generate_file_map(client: "AsyncOpenAI", model: str, prompt: str, on_file: Callable[[str, str], None]) -> Tuple[Dict[str, str], bool]:
+    """One generation attempt. Returns the file map and whether it is complete, valid JSON."""
+    if config.LLM_STREAMING:
+        parser = await stream_file_map(client, model, prompt, on_file)
+        return parser.files, parser.complete and bool(parser.files)
+
+    async with asyncio.timeout(config.LLM_TIMEOUT):
+        completion = await client.chat.completions.create(
+            model=model,
+            messages=[{"role": "user", "content": prompt}],
             temperature=0.1,
-            timeout=120.0,
+            timeout=config.LLM_TIMEOUT,
             # IMPORTANT: Request JSON output
             response_format={"type": "json_object"},
         )
-        generated_content = completion.choices[0].message.content.strip()
+    generated_content = completion.choices[0].message.content.strip()
+    record_llm_usage(model, getattr(completion, "usage", None), prompt, len(generated_content))
+
+    # Remove markdown wrappers if any
+    if generated_content.startswith("```json"):
+        generated_content = generated_content.split("```json", 1)[1].rsplit("```", 1)[0]
+
+    # Parse the JSON string into a Python dictionary
+    generated_files_dict = json.loads(generated_content)
+    if not isinstance(generated_files_dict, dict) or not generated_files_dict:
+        raise ValueError("LLM output is not a JSON object of files.")
+    generated_files_dict = {
+        filename: content if isinstance(content, str) else json.dumps(content, indent=2)
+        for filename, content in generated_files_dict.items()
+    }
+    for filename, content in generated_files_dict.items():
+        on_file(filename, content)
+    return generated_files_dict, True
+
+async def request_file_map(task: str, final_prompt: str, on_file: Callable[[str, str], None]) -> Dict[str, str]:
+    """
+    Get the raw file map for a prompt from the cache or the LLM, calling on_file for every file
+    (as soon as it is complete when streaming).
+
+    Generation is hedged: when an attempt runs past the latency percentile threshold, or fails or
+    returns invalid JSON, another attempt is started with the next model of [LLM_MODEL] +
+    LLM_FALLBACK_MODELS (the same model again if there are no fallbacks), up to LLM_MAX_ATTEMPTS.
+    The first complete file map wins and the other attempts are cancelled. Only one attempt
+    streams files to on_file; if a different one wins, its files are passed on when it finishes.
+    """
+    # === Cache lookup: identical prompts (e.g. evaluator retries) skip the LLM call ===
+    cache_key = GenerationCache.key(config.LLM_MODEL, final_prompt)
+    cached_files = generation_cache.get(cache_key)
+    if cached_files is not None:
+        print(f"LLM cache hit for '{task}' ({cache_key[:12]}).")
+        metrics.inc("llm_requests_total", result="cache_hit")
+        for filename, content in cached_files.items():
+            on_file(filename, content)
+        return cached_files
+
+    # === Hedged LLM calls ===
+    client = lazy_import("openai").AsyncOpenAI(base_url=config.LLM_BASE_URL, api_key=config.AIPIPE_TOKEN, http_client=llm_http.get())
+    models = [config.LLM_MODEL] + config.LLM_FALLBACK_MODELS
+    attempts: Dict[asyncio.Task, Tuple[int, str, float]] = {}
+    streaming_attempt: Optional[int] = None
+    partial: Tuple[Optional[int], Dict[str, str]] = (None, {})
+    errors: List[str] = []
+
+    def forward(index: int) -> Callable[[str, str], None]:
+        def emit(filename: str, content: str):
+            nonlocal streaming_attempt
+            if streaming_attempt is None:
+                streaming_attempt = index
+            if streaming_attempt == index:
+                on_file(filename, content)
+        return emit
+
+    def launch(reason: str):
+        index = len(attempts)
+        model = models[index % len(models)]
+        if index:
+            print(f"LLM {reason} for '{task}'; starting attempt {index + 1} with {model}.")
+            metrics.inc("llm_hedges_total", reason=reason.split()[0])
+        # generate_file_map enforces LLM_TIMEOUT itself, so a timed-out stream still returns its complete files
+        attempt = asyncio.create_task(generate_file_map(client, model, final_prompt, forward(index)))
+        attempts[attempt] = (index, model, time.monotonic())
+
+    def settle(index: int, files: Dict[str, str], result: str) -> Dict[str, str]:
+        # Files from an attempt that was not streaming have not reached on_file yet
+        if index != streaming_attempt:
+            for filename, content in files.items():
+                on_file(filename, content)
+        metrics.inc("llm_requests_total", result=result)
+        return files
+
+    launch("first attempt")
+    pending = set(attempts)
+    try:
+        while pending:
+            timeout = None
+            if len(attempts) < config.LLM_MAX_ATTEMPTS:
+                last_start = max(started for _, _, started in attempts.values())
+                timeout = max(0.0, last_start + llm_latency.hedge_delay() - time.monotonic())
+            done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                launch(f"slow (over {llm_latency.hedge_delay():.1f}s)")
+                pending = {attempt for attempt in attempts if not attempt.done()}
+                continue
+
+            for attempt in done:
+                index, model, started = attempts[attempt]
+                reason = "invalid output"
+                try:
+                    files, complete = attempt.result()
+                except Exception as e:
+                    files, complete = {}, False
+                    # JSONDecodeError is a ValueError; anything else (timeouts, HTTP errors) is a failure
+                    reason = "invalid output" if isinstance(e, ValueError) else "failure"
+                    errors.append(f"{model}: {e!r}")
+                    print(f"LLM attempt {index + 1} ({model}) failed: {e!r}")
+                if complete:
+                    elapsed = time.monotonic() - started
+                    llm_latency.record(elapsed)
+                    print(f"LLM attempt {index + 1} ({model}) won after {elapsed:.1f}s.")
+                    generation_cache.put(cache_key, files)
+                    return settle(index, files, "ok" if index == 0 else "hedged")
+                if files:
+                    errors.append(f"{model}: truncated after {len(files)} file(s)")
+                    if len(files) > len(partial[1]):
+                        partial = (index, files)
+                if len(attempts) < config.LLM_MAX_ATTEMPTS:
+                    launch(reason)
+                    pending = {attempt for attempt in attempts if not attempt.done()}
+    finally:
+        for attempt in attempts:
+            attempt.cancel()
+
+    if partial[1]:
+        # Partial output: deploy what is complete, but never cache it
+        print(f"Warning: LLM output was truncated; recovered {len(partial[1])} complete file(s).")
+        return settle(partial[0], partial[1], "partial")
+    metrics.inc("llm_requests_total", result="error")
+    print(f"LLM API call or JSON parsing failed: {'; '.join(errors)}")
+    raise HTTPException(status_code=504, detail=f"LLM API call or JSON parsing failed: {'; '.join(errors)}")
+
+
+# === Shared GitHub client ===
+class GitHubStats:
+    """
+    Counts GitHub API requests process-wide and per job, and tracks rate-limit headroom.
+    A job's counter lives in a context variable, so tasks and threads started by the job add to it.
+    """
 
-        # Remove markdown wrappers if any
-        if generated_content.startswith("```json"):
-            generated_content = generated_content.split("```json", 1)[1].rsplit("```", 1)[0]
-        
-        # Parse the JSON string into a Python dictionary
-        import json
-        generated_files_dict = json.loads(generated_content)
+    def __init__(self):
+        self.total_requests = 0
+        self.rate_limit_remaining: Optional[int] = None
+        self._lock = threading.Lock()
+        self._counter: contextvars.ContextVar[Optional[List[int]]] = contextvars.ContextVar("github_requests", default=None)
+
+    def record(self, headers):
+        remaining = headers.get("x-ratelimit-remaining")
+        counter = self._counter.get()
+        with self._lock:
+            self.total_requests += 1
+            if remaining is not None and str(remaining).isdigit():
+                self.rate_limit_remaining = int(remaining)
+            if counter is not None:
+                counter[0] += 1
+        metrics.inc("github_api_requests_total")
+        if remaining is not None and str(remaining).isdigit():
+            metrics.set("github_rate_limit_remaining", int(remaining))
+
+    def begin_job(self):
+        self._counter.set([0])
+
+    def job_requests(self) -> int:
+        counter = self._counter.get()
+        return counter[0] if counter else 0
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            return {"requests": self.total_requests, "rate_limit_remaining": self.rate_limit_remaining}
+
+github_stats = GitHubStats()
+
+class GitHubError(Exception):
+    """A GitHub API call that failed; status is the HTTP status code (None for transport errors)."""
+
+    def __init__(self, status: Optional[int], message: str):
+        super().__init__(f"GitHub API error {status}: {message}" if status else f"GitHub API error: {message}")
+        self.status = status
+
+class GitHubScheduler:
+    """
+    Admission control for every GitHub request, shared by all concurrent builds:
+    - Content-creating requests take a token from each write budget: a bucket of GITHUB_WRITES_PER_MINUTE
+      refilled over a minute and one of GITHUB_WRITES_PER_HOUR refilled over an hour, matching GitHub's
+      secondary limits. A burst of builds is not slowed down until it would exceed them. Waiting writes are
+      served earliest job deadline first (round 2+ jobs get the shorter REVISION_DEADLINE), so under
+      sustained load builds finish one by one instead of all at the end.
+    - When the primary rate limit is nearly spent (GITHUB_RATE_LIMIT_RESERVE left) or GitHub asks to
+      back off (Retry-After, secondary limit), every request waits until the limit resets.
+    - repo_lock serializes commits to one repository, so concurrent jobs never race on its ref.
+    A job's deadline lives in a context variable (see begin_job).
+    """
 
-        # Return the dictionary of files AND the binary attachments
-        return generated_files_dict, binary_files_to_commit
+    def __init__(self, writes_per_minute: int, writes_per_hour: int, reserve: int):
+        self.reserve = reserve
+        # [capacity, tokens per second, tokens] per write budget
+        self._budgets = [[float(limit), limit / window, float(limit)] for limit, window in ((writes_per_minute, 60), (writes_per_hour, 3600)) if limit > 0]
+        self._minute_budget = self._budgets[0] if writes_per_minute > 0 else None
+        self._refilled = time.monotonic()
+        self._waiters: List[Tuple[Tuple[float, int], asyncio.Future]] = []
+        self._sequence = itertools.count()
+        self._dispatcher: Optional[asyncio.Task] = None
+        self._paused_until = 0.0
+        self._repo_locks: Dict[str, asyncio.Lock] = {}
+        self._job: contextvars.ContextVar[float] = contextvars.ContextVar("github_job_deadline", default=float("inf"))
+
+    def begin_job(self, deadline: float):
+        """Order this job's writes by deadline (a time.time() value)."""
+        self._job.set(deadline)
+
+    def repo_lock(self, full_name: str) -> asyncio.Lock:
+        return self._repo_locks.setdefault(full_name, asyncio.Lock())
+
+    async def acquire(self, write: bool):
+        """Wait until a request may be sent."""
+        started = time.monotonic()
+        await self._wait_unpaused()
+        if write and self._budgets:
+            loop = asyncio.get_running_loop()
+            future = loop.create_future()
+            heapq.heappush(self._waiters, ((self._job.get(), next(self._sequence)), future))
+            if self._dispatcher is None or self._dispatcher.done():
+                self._dispatcher = loop.create_task(self._dispatch())
+            await future
+        metrics.observe("github_scheduler_wait_seconds", time.monotonic() - started, kind="write" if write else "read")
+
+    async def _wait_unpaused(self):
+        while (wait := self._paused_until - time.monotonic()) > 0:
+            await asyncio.sleep(wait)
+
+    async def _dispatch(self):
+        while self._waiters:
+            await self._wait_unpaused()
+            now = time.monotonic()
+            for budget in self._budgets:
+                budget[2] = min(budget[0], budget[2] + max(now - self._refilled, 0) * budget[1])
+            self._refilled = max(now, self._refilled)
+            wait = max((1 - tokens) / rate for _, rate, tokens in self._budgets)
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+            # The most urgent writer is chosen only once every budget has a token
+            _, future = heapq.heappop(self._waiters)
+            if not future.done():  # done means the waiting request was cancelled
+                for budget in self._budgets:
+                    budget[2] -= 1
+                future.set_result(None)
+
+    def pause(self, seconds: float, reason: str):
+        until = time.monotonic() + seconds
+        if seconds > 0 and until > self._paused_until:
+            self._paused_until = until
+            # Resume with an empty per-minute budget rather than a burst that hits the limit again
+            if self._minute_budget is not None:
+                self._minute_budget[2] = 0.0
+            self._refilled = until
+            print(f"GitHub requests paused for {seconds:.1f}s: {reason}")
+
+    def observe(self, response: httpx.Response):
+        """Track the primary rate limit; pause before it runs out rather than collecting 403s."""
+        headers = response.headers
+        remaining, reset = headers.get("x-ratelimit-remaining", ""), headers.get("x-ratelimit-reset", "")
+        if headers.get("x-ratelimit-resource", "core") != "core" or not remaining.isdigit() or not reset.isdigit():
+            return
+        if int(remaining) <= self.reserve:
+            self.pause(int(reset) - time.time() + 1, f"{remaining} requests left until the rate limit resets")
+
+    def backoff(self, response: httpx.Response, throttles: int) -> Optional[float]:
+        """Seconds to wait if response is a rate-limit rejection, otherwise None."""
+        if response.status_code not in (403, 429):
+            return None
+        retry_after, reset = response.headers.get("retry-after", ""), response.headers.get("x-ratelimit-reset", "")
+        if retry_after.isdigit():
+            return float(retry_after)
+        if response.headers.get("x-ratelimit-remaining") == "0" and reset.isdigit():
+            return max(1.0, int(reset) - time.time() + 1)
+        if response.status_code == 429 or "rate limit" in response.text.lower():
+            # Secondary limit without Retry-After: GitHub asks for at least a minute, growing exponentially
+            return 60.0 * 2 ** throttles
+        return None
 
-    except Exception as e:
-        print(f"LLM API call or JSON parsing failed: {e}")
-        traceback.print_exc()
-        raise HTTPException(status_code=504, detail=f"LLM API call or JSON parsing failed: {e}")
+github_scheduler = GitHubScheduler(config.GITHUB_WRITES_PER_MINUTE, config.GITHUB_WRITES_PER_HOUR, config.GITHUB_RATE_LIMIT_RESERVE)
 
+class GitHubClient:
+    """
+    Async client for the GitHub REST endpoints the pipeline uses. All jobs share one connection pool,
+    and every request is admitted by the GitHubScheduler. Rate-limit rejections are retried after the
+    wait GitHub asks for (up to GITHUB_MAX_BACKOFF); transient failures (5xx, connection errors) are
+    retried with backoff.
+    """
+    RETRIES = 3
+    RATE_LIMIT_RETRIES = 5
+    WRITE_METHODS = ("POST", "PATCH", "PUT", "DELETE")
+
+    def __init__(self, api_url: str, token: Optional[str], pool_size: int, scheduler: GitHubScheduler):
+        self.api_url = api_url.rstrip("/")
+        self.scheduler = scheduler
+        self._http = LoopBoundClient(
+            base_url=self.api_url, timeout=30.0, follow_redirects=True,
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+            headers={
+                "Authorization": f"token {token}",
+                "Accept": "application/vnd.github.v3+json",
+                "X-GitHub-Api-Version": "2022-11-28",
+            },
+            event_hooks={"response": [self._record]},
+        )
 
-# === GitHub helpers ===
-def get_existing_file(repo, file_path):
-    try:
-        return repo.get_contents(file_path, ref=repo.default_branch)
-    except UnknownObjectException:
+    async def _record(self, response: httpx.Response):
+        github_stats.record(response.headers)
+        self.scheduler.observe(response)
+
+    async def request(self, method: str, path: str, **kwargs) -> httpx.Response:
+        """Send a request and return the response; raises GitHubError for error statuses."""
+        failures = throttles = 0
+        while True:
+            await self.scheduler.acquire(method in self.WRITE_METHODS)
+            try:
+                response = await self._http.get().request(method, path, **kwargs)
+            except httpx.TransportError as e:
+                failures += 1
+                if failures == self.RETRIES:
+                    raise GitHubError(None, str(e) or type(e).__name__)
+                await asyncio.sleep(2 ** (failures - 1))
+                continue
+            if response.status_code < 400:
+                return response
+
+            wait = self.scheduler.backoff(response, throttles)
+            if wait is not None and throttles < self.RATE_LIMIT_RETRIES and wait <= config.GITHUB_MAX_BACKOFF:
+                throttles += 1
+                metrics.inc("github_rate_limited_total", status=str(response.status_code))
+                self.scheduler.pause(wait, f"{response.status_code} on {method} {path}")
+                continue
+            if response.status_code >= 500 and failures + 1 < self.RETRIES:
+                failures += 1
+                await asyncio.sleep(2 ** (failures - 1))
+                continue
+            try:
+                message = response.json().get("message", response.text)
+            except ValueError:
+                message = response.text
+            raise GitHubError(response.status_code, message)
+
+    async def json(self, method: str, path: str, **kwargs):
+        return (await self.request(method, path, **kwargs)).json()
+
+    async def download(self, path: str, target: IO[bytes]):
+        """Stream a (possibly redirected) download into target."""
+        await self.scheduler.acquire(False)
+        async with self._http.get().stream("GET", path, timeout=60.0) as response:
+            if response.status_code >= 400:
+                raise GitHubError(response.status_code, f"download of {path} failed")
+            async for chunk in response.aiter_bytes(64 * 1024):
+                target.write(chunk)
+
+github = GitHubClient(config.GITHUB_API_URL, config.GITHUB_TOKEN, config.GITHUB_POOL_SIZE, github_scheduler)
+
+class TTLCache:
+    """Small thread-safe cache whose entries expire after a fixed number of seconds."""
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._items: Dict[object, Tuple[float, object]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the cached value, or None if it is missing or expired."""
+        with self._lock:
+            item = self._items.get(key)
+            if item and item[0] > time.monotonic():
+                return item[1]
         return None
 
-def enable_github_pages(repo):
-    """
-    Try to enable GitHub Pages programmatically.
-    Prefer PyGithub method when available. Fallback to REST API.
-    """
-    owner = repo.owner.login
-    repo_name = repo.name
-    branch = repo.default_branch
-    print(f"Attempting to enable GitHub Pages for {owner}/{repo_name} on branch {branch} (root).")
+    async def get_or_load(self, key, loader: Callable[[], Awaitable[object]]):
+        """Return the cached value; on a miss, await loader() and cache its result."""
+        value = self.get(key)
+        if value is None:
+            value = await loader()
+            self.set(key, value)
+        return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._items[key] = (time.monotonic() + self.ttl, value)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+github_cache = TTLCache(config.GITHUB_CACHE_TTL)
 
-    # Try PyGithub high-level API first
+async def get_github_login() -> str:
+    async def load_login():
+        return (await github.json("GET", "/user"))["login"]
+    return await github_cache.get_or_load("user", load_login)
+
+async def get_task_repo(repo_name: str) -> Dict:
+    """Cached repository lookup for the authenticated user; raises GitHubError (404) if missing."""
+    full_name = f"{await get_github_login()}/{repo_name}"
+    return await github_cache.get_or_load(("repo", full_name), lambda: github.json("GET", f"/repos/{full_name}"))
+
+# === GitHub helpers ===
+async def get_existing_file(repo: Dict, file_path: str) -> Optional[str]:
+    """Text of a file on the default branch, or None if it does not exist."""
     try:
-        create_pages = getattr(repo, "create_pages_site", None)
-        if callable(create_pages):
-            try:
-                repo.create_pages_site(source_type="branch", source_branch=branch, source_path="/")
-                print("GitHub Pages enabled via PyGithub.")
-                return True
-            except GithubException as e:
-                print(f"PyGithub create_pages_site failed: {e.status} {e.data if hasattr(e,'data') else e}")
-        else:
-            print("PyGithub create_pages_site not available in this PyGithub version.")
-    except Exception as e:
-        print(f"PyGithub pages attempt raised: {e}")
+        response = await github.request(
+            "GET", f"/repos/{repo['full_name']}/contents/{file_path}", headers={"Accept": "application/vnd.github.raw+json"}
+        )
+    except GitHubError as e:
+        if e.status == 404:
+            return None
+        raise
+    return response.text
+
+# Repositories with Pages enabled; kept for the process lifetime (no TTL), like the blob manifests
+pages_enabled_repos: set = set()
 
-    # Fallback: use GitHub REST API
+async def enable_github_pages(repo: Dict) -> bool:
+    """
+    Enable GitHub Pages once per repository; a successful result is remembered so later rounds skip the API calls.
+    """
+    if repo["full_name"] in pages_enabled_repos:
+        return True
+    with metrics.span("pages_enable"):
+        enabled = await request_github_pages(repo)
+    if enabled:
+        pages_enabled_repos.add(repo["full_name"])
+    return enabled
+
+async def request_github_pages(repo: Dict) -> bool:
+    """Enable GitHub Pages for the default branch (root) through the REST API."""
+    branch = repo["default_branch"]
+    print(f"Attempting to enable GitHub Pages for {repo['full_name']} on branch {branch} (root).")
     try:
-        url = f"https://api.github.com/repos/{owner}/{repo_name}/pages"
-        headers = {
-            "Authorization": f"token {config.GITHUB_TOKEN}",
-            "Accept": "application/vnd.github.v3+json",
-            "X-GitHub-Api-Version": "2022-11-28"
-        }
-        payload = {"source": {"branch": branch, "path": "/"}}
-        response = requests.post(url, json=payload, headers=headers, timeout=20)
-        if response.status_code in (201, 204):
-            print("GitHub Pages enabled via REST API.")
-            return True
-        if response.status_code == 422 and "already configured" in response.text.lower():
+        await github.request("POST", f"/repos/{repo['full_name']}/pages", json={"source": {"branch": branch, "path": "/"}})
+        print("GitHub Pages enabled via REST API.")
+        return True
+    except GitHubError as e:
+        if e.status in (409, 422) and ("already" in str(e).lower()):
             print("GitHub Pages already configured.")
             return True
-        print(f"REST API Pages enable returned {response.status_code}: {response.text}")
-    except requests.RequestException as e:
         print(f"REST API Pages enable attempt failed: {e}")
 
     print("Could not enable GitHub Pages programmatically. Manual enabling may be required.")
     return False
 
-def verify_deployment(pages_url: str, timeout: int) -> bool:
-    print(f"Verifying deployment at {pages_url}. Will wait up to {timeout} seconds.")
-    start_time = time.time()
-    while time.time() - start_time < timeout:
+class DeploymentVerifier:
+    """
+    Tracks pending Pages deployments. Each deployment is a small task on the event loop that polls the
+    Pages builds API for its exact commit SHA with adaptive backoff; its callback fires as soon as
+    that build succeeds, errors or times out.
+    """
+    INITIAL_INTERVAL = 2.0
+    MAX_INTERVAL = 15.0
+    BACKOFF_FACTOR = 1.5
+
+    def __init__(self, timeout: int):
+        self.timeout = timeout
+        self._tasks: set = set()
+
+    def watch(self, owner: str, repo_name: str, commit_sha: str, on_done: Callable[[bool], None], timeout: Optional[float] = None):
+        """Track a deployment; on_done(verified) is called once the Pages build for commit_sha finishes."""
+        timeout = self.timeout if timeout is None else max(timeout, 0)
+        print(f"Verifying Pages build of {owner}/{repo_name}@{commit_sha[:7]}. Will wait up to {timeout:.0f} seconds.")
+        deployment = {
+            "owner": owner, "repo": repo_name, "commit_sha": commit_sha, "on_done": on_done,
+            "deadline": time.monotonic() + timeout, "interval": self.INITIAL_INTERVAL,
+            "job": metrics.current_job(), "started": time.monotonic(),
+        }
+        task = asyncio.get_running_loop().create_task(self._watch(deployment))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def pending(self) -> int:
+        return len(self._tasks)
+
+    async def _build_status(self, deployment: Dict) -> Optional[str]:
+        """Status of the Pages build for the deployment's commit, or None if there is no such build yet."""
         try:
-            response = requests.get(pages_url, timeout=10)
-            if response.status_code == 200:
-                print("Deployment verified successfully (HTTP 200).")
-                return True
-        except requests.exceptions.RequestException:
-            pass
-        time.sleep(5)
-    print("Error: Deployment verification timed out.")
-    return False
+            builds = await github.json("GET", f"/repos/{deployment['owner']}/{deployment['repo']}/pages/builds", params={"per_page": 10})
+        except GitHubError as e:
+            if e.status == 404:
+                return None
+            raise
+        for build in builds:
+            if build.get("commit") == deployment["commit_sha"]:
+                return build.get("status")
+        return None
 
-def create_or_update_file(repo, file_path: str, commit_message: str, content: str):
+    async def _watch(self, deployment: Dict):
+        name = f"{deployment['owner']}/{deployment['repo']}@{deployment['commit_sha'][:7]}"
+        while True:
+            await asyncio.sleep(min(deployment["interval"], max(deployment["deadline"] - time.monotonic(), 0)))
+            try:
+                status = await self._build_status(deployment)
+            except (GitHubError, ValueError) as e:
+                print(f"Pages build status check failed for {deployment['repo']}: {e}")
+                status = None
+
+            if status == "built":
+                print(f"Deployment verified successfully: Pages build for {name} succeeded.")
+                return self._finish(deployment, True, "built")
+            if status == "errored":
+                print(f"Error: Pages build for {name} failed.")
+                return self._finish(deployment, False, "errored")
+            if time.monotonic() >= deployment["deadline"]:
+                print(f"Error: Deployment verification timed out for {name}.")
+                return self._finish(deployment, False, "timeout")
+            deployment["interval"] = min(deployment["interval"] * self.BACKOFF_FACTOR, self.MAX_INTERVAL)
+
+    def _finish(self, deployment: Dict, verified: bool, result: str):
+        metrics.record_span(deployment["job"], "pages_verify", time.monotonic() - deployment["started"], result=result)
+        try:
+            deployment["on_done"](verified)
+        except Exception as e:
+            print(f"Deployment callback for {deployment['repo']} failed: {e}")
+            traceback.print_exc()
+
+deployment_verifier = DeploymentVerifier(config.DEPLOYMENT_TIMEOUT)
+
+def attachment_repo_files(binary_files: Dict[str, IO[bytes]]) -> Dict[str, IO[bytes]]:
     """
-    Create or update a text file. content must be a str.
+    Map attachments to repository files, committed byte for byte (so Pages serves images and other
+    binary assets as they are). Contents stay spooled; they are only read when their blob is created.
     """
-    file = get_existing_file(repo, file_path)
-    if file:
-        existing = file.decoded_content.decode("utf-8")
-        if existing != content:
-            repo.update_file(file.path, commit_message, content, file.sha, branch=repo.default_branch)
-            print(f"Updated file: {file_path}")
+    return {sanitize_filename(filename): spool for filename, spool in binary_files.items()}
+
+def git_blob_sha(content: Union[str, IO[bytes]]) -> str:
+    """The SHA-1 git gives a blob with this content, computed locally (no API call)."""
+    if isinstance(content, str):
+        data = content.encode("utf-8")
+        return hashlib.sha1(b"blob %d\0" % len(data) + data).hexdigest()
+    stored = attachment_store.blob_sha(content)
+    if stored:
+        # Precomputed when the attachment was stored
+        return stored
+    content.seek(0, os.SEEK_END)
+    digest = hashlib.sha1(b"blob %d\0" % content.tell())
+    content.seek(0)
+    for chunk in iter(lambda: content.read(64 * 1024), b""):
+        digest.update(chunk)
+    content.seek(0)
+    return digest.hexdigest()
+
+class RepoManifests:
+    """
+    Manifest of path -> blob SHA for the branch head of each task repository, keyed by full name.
+    Filled from one recursive tree listing and kept up to date by our own commits, so unchanged
+    files can be detected by hashing new content locally.
+    """
+
+    def __init__(self):
+        self._manifests: Dict[str, Tuple[str, Dict[str, str]]] = {}
+        self._lock = threading.Lock()
+
+    async def get(self, repo: Dict, head: Dict) -> Dict[str, str]:
+        """Manifest for head (a commit object); costs one tree listing unless it is already known."""
+        with self._lock:
+            cached = self._manifests.get(repo["full_name"])
+        if cached and cached[0] == head["sha"]:
+            return cached[1]
+        if not head["parents"]:
+            # Root commit (the auto_init README): nothing worth a listing call
+            blobs = {}
         else:
-            print(f"No change for file: {file_path}")
-    else:
-        repo.create_file(file_path, commit_message, content, branch=repo.default_branch)
-        print(f"Created file: {file_path}")
+            tree = await github.json("GET", f"/repos/{repo['full_name']}/git/trees/{head['tree']['sha']}", params={"recursive": "1"})
+            blobs = {element["path"]: element["sha"] for element in tree["tree"] if element["type"] == "blob"}
+        self.update(repo["full_name"], head["sha"], blobs)
+        return blobs
 
-def create_and_deploy(request_data: BuildRequest, generated_files: dict, binary_files: dict):
-    g = Github(config.GITHUB_TOKEN)
-    user = g.get_user()
-    repo_name = request_data.task
+    def known(self, full_name: str) -> Dict[str, str]:
+        """Last manifest seen for the repository, without checking that it is still current."""
+        with self._lock:
+            cached = self._manifests.get(full_name)
+        return cached[1] if cached else {}
+
+    def update(self, full_name: str, commit_sha: str, blobs: Dict[str, str]):
+        with self._lock:
+            self._manifests[full_name] = (commit_sha, blobs)
+
+repo_manifests = RepoManifests()
+
+class Base64BlobBody:
+    """
+    JSON body {"encoding": "base64", "content": ...} for a spooled file, base64-encoded chunk by chunk
+    as it is sent. Iterating again starts over, so GitHubClient retries can resend it.
+    """
+    PREFIX = b'{"encoding": "base64", "content": "'
+    SUFFIX = b'"}'
+
+    def __init__(self, source: IO[bytes]):
+        self.source = source
+        source.seek(0, os.SEEK_END)
+        self.length = len(self.PREFIX) + (source.tell() + 2) // 3 * 4 + len(self.SUFFIX)
+
+    async def __aiter__(self):
+        self.source.seek(0)
+        yield self.PREFIX
+        # Chunks are a multiple of 3 bytes, so the concatenated output equals a one-shot b64encode
+        for chunk in iter(lambda: self.source.read(3 * 64 * 1024), b""):
+            yield base64.b64encode(chunk)
+        yield self.SUFFIX
+
+async def create_blob(repo: Dict, content: Union[str, IO[bytes]]) -> str:
+    """Create a git blob from a string or a spooled file and return its SHA."""
+    path = f"/repos/{repo['full_name']}/git/blobs"
+    if isinstance(content, str):
+        return (await github.json("POST", path, json={"content": content, "encoding": "utf-8"}))["sha"]
+    body = Base64BlobBody(content)
+    headers = {"Content-Type": "application/json", "Content-Length": str(body.length)}
+    return (await github.json("POST", path, content=body, headers=headers))["sha"]
+
+class BlobUploader:
+    """
+    Creates git blobs in background tasks as generated files arrive, so uploads overlap with the
+    rest of the LLM output. commit_files() reuses the blobs whose content is still the final content.
+    """
+
+    def __init__(self, repo: Dict):
+        self.repo = repo
+        self._uploads: Dict[str, Tuple[str, asyncio.Task]] = {}
+        # Blobs the repository already has need no upload
+        self._known_blobs = set(repo_manifests.known(repo["full_name"]).values())
+
+    def submit(self, file_path: str, content: str):
+        if content and git_blob_sha(content) not in self._known_blobs:
+            self._uploads[file_path] = (content, asyncio.get_running_loop().create_task(create_blob(self.repo, content)))
+
+    async def blob_shas(self, files: Dict[str, Union[str, IO[bytes]]]) -> Dict[str, str]:
+        """Wait for pending uploads; return {path: blob SHA} for uploads matching the final files."""
+        shas = {}
+        for file_path, (content, task) in self._uploads.items():
+            try:
+                sha = await task
+            except Exception as e:
+                print(f"Warning: Early blob upload for {file_path} failed: {e}")
+                continue
+            if files.get(file_path) == content:
+                shas[file_path] = sha
+        return shas
+
+async def commit_files(repo: Dict, files: Dict[str, Union[str, IO[bytes]]], commit_message: str, blob_shas: Optional[Dict[str, str]] = None) -> str:
+    """
+    Commit all files at once via the Git Trees API: one blob per file, one tree, one commit,
+    and a single move of the branch ref (so GitHub Pages rebuilds only once).
+    Values are strings or spooled files; spooled files are read one at a time.
+    blob_shas holds blobs that were already uploaded (see BlobUploader) and are not created again.
+    Files whose locally computed blob SHA matches the repository manifest are left out entirely.
+    Returns the SHA of the branch head after the commit.
+    """
+    blob_shas = blob_shas or {}
+    full_name, branch = repo["full_name"], repo["default_branch"]
+    # One commit at a time per repository: a concurrent job would otherwise commit on the same parent
+    async with github_scheduler.repo_lock(full_name):
+        ref = await github.json("GET", f"/repos/{full_name}/git/ref/heads/{branch}")
+        parent = await github.json("GET", f"/repos/{full_name}/git/commits/{ref['object']['sha']}")
+        if not files:
+            print("No files to commit.")
+            return parent["sha"]
+
+        manifest = await repo_manifests.get(repo, parent)
+        known_blobs = set(manifest.values())
+        new_manifest = dict(manifest)
+        tree_elements = []
+        for file_path, content in files.items():
+            local_sha = git_blob_sha(content)
+            if manifest.get(file_path) == local_sha:
+                continue
+            # A blob already in the repository (e.g. a moved file) can be referenced without uploading it
+            blob_sha = blob_shas.get(file_path) or (local_sha if local_sha in known_blobs else await create_blob(repo, content))
+            tree_elements.append({"path": file_path, "mode": "100644", "type": "blob", "sha": blob_sha})
+            new_manifest[file_path] = blob_sha
+
+        unchanged = len(files) - len(tree_elements)
+        if not tree_elements:
+            print(f"No changes to commit on {branch} ({unchanged} unchanged file(s)).")
+            return parent["sha"]
+
+        tree = await github.json("POST", f"/repos/{full_name}/git/trees", json={"tree": tree_elements, "base_tree": parent["tree"]["sha"]})
+        if tree["sha"] == parent["tree"]["sha"]:
+            print(f"No changes to commit on {branch}.")
+            return parent["sha"]
+
+        commit = await github.json(
+            "POST", f"/repos/{full_name}/git/commits", json={"message": commit_message, "tree": tree["sha"], "parents": [parent["sha"]]}
+        )
+        await github.request("PATCH", f"/repos/{full_name}/git/refs/heads/{branch}", json={"sha": commit["sha"]})
+        repo_manifests.update(full_name, commit["sha"], new_manifest)
+        print(f"Committed {len(tree_elements)} file(s) to {branch}, {unchanged} unchanged: {commit['sha']}")
+        return commit["sha"]
+
+async def get_or_create_task_repo(repo_name: str) -> Dict:
+    """Return the task repository, creating it (auto-initialised) if it does not exist yet."""
+    login = await get_github_login()
+    repo = github_cache.get(("repo", f"{login}/{repo_name}"))
+    if repo is not None:
+        return repo
 
     try:
-        repo = user.create_repo(repo_name, auto_init=True, private=False)
-        print(f"Created repository: {repo.full_name}")
-    except GithubException as e:
-        if getattr(e, "status", None) == 422:
-            repo = g.get_repo(f"{user.login}/{repo_name}")
-            print(f"Using existing repository: {repo.full_name}")
+        repo = await github.json("POST", "/user/repos", json={"name": repo_name, "auto_init": True, "private": False})
+        github_cache.set(("repo", repo["full_name"]), repo)
+        print(f"Created repository: {repo['full_name']}")
+    except GitHubError as e:
+        if e.status == 422:
+            repo = await get_task_repo(repo_name)
+            print(f"Using existing repository: {repo['full_name']}")
         else:
             raise e
+    return repo
+
+# === Git push deployment backend ===
+class GitDeployer:
+    """
+    Deploys through a cached shallow clone per task: files are written to the working tree and
+    pushed as one commit with a single `git push` (one pack upload, no REST calls). Used when
+    DEPLOY_BACKEND=git; GIT_REMOTE_BASE may point at a local directory of bare repositories.
+    """
+
+    def __init__(self, cache_dir: str, remote_base: str, owner: str, token: Optional[str]):
+        self.cache_dir = cache_dir
+        self.remote_base = remote_base.rstrip("/")
+        self.owner = owner
+        self._env: Dict[str, str] = {}
+        if token and self.remote_base.startswith("https://"):
+            # Pass the token as a header for this process only; it never lands in .git/config
+            basic = base64.b64encode(f"x-access-token:{token}".encode()).decode("ascii")
+            self._env = {
+                "GIT_CONFIG_COUNT": "1",
+                "GIT_CONFIG_KEY_0": "http.extraHeader",
+                "GIT_CONFIG_VALUE_0": f"Authorization: Basic {basic}",
+            }
+        self._locks: Dict[str, threading.Lock] = {}
+        self._locks_guard = threading.Lock()
+
+    def remote_url(self, repo_name: str) -> str:
+        return f"{self.remote_base}/{self.owner}/{repo_name}.git"
+
+    def _lock(self, repo_name: str) -> threading.Lock:
+        with self._locks_guard:
+            return self._locks.setdefault(repo_name, threading.Lock())
+
+    def _checkout(self, repo_name: str, branch: str) -> "GitRepo":
+        """Return the clone for repo_name, reset to the remote head of branch."""
+        GitRepo = lazy_import("git").Repo
+        path = os.path.join(self.cache_dir, self.owner, repo_name)
+        if os.path.isdir(os.path.join(path, ".git")):
+            clone = GitRepo(path)
+            clone.git.update_environment(**self._env)
+        else:
+            shutil.rmtree(path, ignore_errors=True)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            clone = GitRepo.clone_from(self.remote_url(repo_name), path, depth=1, env=self._env)
+            clone.git.update_environment(**self._env)
+            print(f"Cloned {repo_name} into {path}")
+
+        if clone.git.ls_remote("--heads", "origin", branch):
+            clone.git.fetch("--depth=1", "origin", branch)
+            # Forced, so edits a failed job left in tracked files do not leak into the next commit
+            clone.git.checkout("-f", "-B", branch, "FETCH_HEAD")
+        else:
+            # Empty remote: the first commit starts the branch from an empty index
+            clone.git.symbolic_ref("HEAD", f"refs/heads/{branch}")
+            clone.git.read_tree("--empty")
+        clone.git.clean("-fdx")
+        return clone
+
+    def snapshot(self, repo_name: str, branch: str) -> Tuple[Dict[str, str], Dict[str, int]]:
+        """Same result as load_repo_snapshot(), read from the refreshed local clone."""
+        text_files: Dict[str, str] = {}
+        other_files: Dict[str, int] = {}
+        with self._lock(repo_name):
+            clone = self._checkout(repo_name, branch)
+            for path in clone.git.ls_files("-z").split("\0"):
+                full_path = os.path.join(clone.working_tree_dir, path)
+                if not path or not os.path.isfile(full_path):
+                    continue
+                with open(full_path, "rb") as source:
+                    add_snapshot_file(text_files, other_files, path, os.path.getsize(full_path), source.read)
+        return text_files, other_files
+
+    def commit_files(self, repo_name: str, branch: str, files: Dict[str, Union[str, IO[bytes]]], commit_message: str) -> str:
+        """Write files, commit and push once. Returns the SHA of the branch head after the push."""
+        with self._lock(repo_name):
+            for attempt in range(2):
+                clone = self._checkout(repo_name, branch)
+                root = os.path.realpath(clone.working_tree_dir)
+                written = 0
+                for file_path, content in files.items():
+                    full_path = os.path.realpath(os.path.join(root, file_path))
+                    relative = os.path.relpath(full_path, root)
+                    if relative.startswith("..") or relative.split(os.sep)[0] == ".git":
+                        print(f"Warning: Skipping unsafe path {file_path}")
+                        continue
+                    os.makedirs(os.path.dirname(full_path), exist_ok=True)
+                    if isinstance(content, str):
+                        with open(full_path, "w", encoding="utf-8", newline="") as target:
+                            target.write(content)
+                    else:
+                        content.seek(0)
+                        with open(full_path, "wb") as target:
+                            shutil.copyfileobj(content, target)
+                    written += 1
+
+                clone.git.add("--all")
+                if clone.head.is_valid() and not clone.index.diff("HEAD"):
+                    print(f"No changes to commit on {branch}.")
+                    return clone.head.commit.hexsha
+
+                git = lazy_import("git")
+                actor = git.Actor(self.owner, f"{self.owner}@users.noreply.github.com")
+                commit = clone.index.commit(commit_message, author=actor, committer=actor)
+                try:
+                    clone.git.push("origin", f"HEAD:refs/heads/{branch}")
+                except git.GitCommandError as e:
+                    # Someone else moved the branch since our fetch: start over from the new head once
+                    if attempt:
+                        raise
+                    print(f"Push to {repo_name} rejected, retrying on the new head: {e.stderr.strip()}")
+                    continue
+                print(f"Pushed {written} file(s) to {branch}: {commit.hexsha}")
+                return commit.hexsha
+
+git_deployer = GitDeployer(config.GIT_CACHE_DIR, config.GIT_REMOTE_BASE, config.GITHUB_USERNAME, config.GITHUB_TOKEN)
+
+async def deploy_files(repo: Dict, files: Dict[str, Union[str, IO[bytes]]], commit_message: str, uploader: Optional[BlobUploader] = None) -> str:
+    """Commit files with the configured DEPLOY_BACKEND and return the new head SHA."""
+    with metrics.span("github_write"):
+        if config.DEPLOY_BACKEND == "git":
+            # GitPython drives the git CLI synchronously; keep it off the event loop
+            return await asyncio.to_thread(git_deployer.commit_files, repo["name"], repo["default_branch"], files, commit_message)
+        return await commit_files(repo, files, commit_message, await uploader.blob_shas(files) if uploader else None)
+
+async def load_task_snapshot(repo: Dict) -> Tuple[Dict[str, str], Dict[str, int]]:
+    with metrics.span("snapshot"):
+        if config.DEPLOY_BACKEND == "git":
+            return await asyncio.to_thread(git_deployer.snapshot, repo["name"], repo["default_branch"])
+        return await load_repo_snapshot(repo)
+
+async def create_and_deploy(request_data: BuildRequest, generated_files: dict, binary_files: dict, uploader: Optional[BlobUploader] = None):
+    repo_name = request_data.task
+    repo = await get_or_create_task_repo(repo_name)
 
     # README and LICENSE content
     readme_content = f"""# {repo_name.replace('-', ' ').title()}
@@ -383,125 +2429,262 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
+    files: Dict[str, Union[str, IO[bytes]]] = {}
     for filename, content in generated_files.items():
         if not content: # Skip empty files
             print(f"Skipping empty file: {filename}")
             continue
-        create_or_update_file(repo, filename, f"Create/Update {filename}", str(content))
-    create_or_update_file(repo, "README.md", "Create/Update README", readme_content)
-    create_or_update_file(repo, "LICENSE", "Create/Update LICENSE", license_text)
-
-    # Save attachments: text as text, binary as base64
-    for filename, content_bytes in binary_files.items():
-        safe_name = sanitize_filename(filename)
-        # Detect text files by extension
-        if safe_name.endswith(('.csv', '.txt', '.md', '.json', '.js', '.xml', '.yaml', '.yml')):
-            # Save as plain text
-            text_content = content_bytes.decode('utf-8', errors='ignore')
-            create_or_update_file(repo, safe_name, f"Add/Update attachment {safe_name}", text_content)
-        else:
-            # Save binary as base64 with .b64 suffix
-            b64_text = base64.b64encode(content_bytes).decode("utf-8")
-            b64_path = f"{safe_name}.b64"
-            create_or_update_file(repo, b64_path, f"Add/Update binary attachment {safe_name}.b64", b64_text)
+        files[filename] = str(content)
+    files["README.md"] = readme_content
+    files["LICENSE"] = license_text
+
+    # Save attachments byte for byte
+    files.update(attachment_repo_files(binary_files))
+
+    # Push everything in a single commit
+    commit_sha = await deploy_files(repo, files, "Create/Update generated files", uploader)
 
     # Attempt to enable GitHub Pages
-    pages_enabled = enable_github_pages(repo)
+    pages_enabled = await enable_github_pages(repo)
     if not pages_enabled:
         print("Warning: GitHub Pages may not be enabled. Check repository settings manually.")
 
-    commit_sha = repo.get_branch(repo.default_branch).commit.sha
     pages_url = f"https://{config.GITHUB_USERNAME}.github.io/{repo_name}/"
+    return repo["html_url"], commit_sha, pages_url
 
-    # Wait and verify
-    verified = verify_deployment(pages_url, config.DEPLOYMENT_TIMEOUT)
-    if not verified:
-        print(f"Warning: Deployment not verified at {pages_url} within timeout.")
-
-    return repo.html_url, commit_sha, pages_url
-
-def revise_and_deploy(request_data: BuildRequest, generated_files: dict, binary_files: dict):
-    g = Github(config.GITHUB_TOKEN)
-    user = g.get_user()
+async def revise_and_deploy(
+    request_data: BuildRequest, generated_files: dict, binary_files: dict,
+    uploader: Optional[BlobUploader] = None, existing_files: Optional[Dict[str, str]] = None,
+):
     repo_name = request_data.task
 
     try:
-        repo = g.get_repo(f"{user.login}/{repo_name}")
-    except UnknownObjectException:
-        raise ValueError(f"Repository {repo_name} not found for revision.")
-
-    readme_file = get_existing_file(repo, "README.md")
-    existing_readme = readme_file.decoded_content.decode("utf-8") if readme_file else ""
+        repo = await get_task_repo(repo_name)
+    except GitHubError as e:
+        if e.status == 404:
+            raise ValueError(f"Repository {repo_name} not found for revision.")
+        raise
+
+    if existing_files is not None:
+        existing_readme = existing_files.get("README.md", "")
+    else:
+        existing_readme = await get_existing_file(repo, "README.md") or ""
     new_readme_content = f"{existing_readme}\n\n### Round {request_data.round} Update\n\n> {request_data.brief}"
 
-    # === THIS IS THE CORRECTED LOOP ===
-    # It now iterates over the 'generated_files' dictionary
+    files: Dict[str, Union[str, IO[bytes]]] = {}
     for filename, content in generated_files.items():
         if not content:
             print(f"Skipping empty file: {filename}")
             continue
-        create_or_update_file(repo, filename, f"Create/Update {filename} (Round {request_data.round})", str(content))
-    
+        files[filename] = str(content)
+
     # Update README
-    create_or_update_file(repo, "README.md", f"Update README for Round {request_data.round}", new_readme_content)
-
-    # === This part for binary_files is correct ===
-    for filename, content in binary_files.items():
-        safe_name = sanitize_filename(filename)
-        # Detect text files by extension
-        if safe_name.endswith(('.csv', '.txt', '.md', '.json', '.js', '.xml', '.yaml', '.yml')):
-            text_content = content.decode('utf-8', errors='ignore')
-            create_or_update_file(repo, safe_name, f"Add/Update attachment {safe_name}", text_content)
-        else:
-            b64_text = base64.b64encode(content).decode("utf-8")
-            b64_path = f"{safe_name}.b64"
-            create_or_update_file(repo, b64_path, f"Add/Update binary attachment {safe_name}.b64", b64_text)
+    files["README.md"] = new_readme_content
 
-    # Ensure pages enabled
-    enable_github_pages(repo)
+    files.update(attachment_repo_files(binary_files))
 
-    commit_sha = repo.get_branch(repo.default_branch).commit.sha
-    pages_url = f"https://{config.GITHUB_USERNAME}.github.io/{repo.name}/"
+    commit_sha = await deploy_files(repo, files, f"Create/Update generated files (Round {request_data.round})", uploader)
+
+    # Ensure pages enabled
+    await enable_github_pages(repo)
 
-    verify_deployment(pages_url, config.DEPLOYMENT_TIMEOUT)
-    return repo.html_url, commit_sha, pages_url
+    pages_url = f"https://{config.GITHUB_USERNAME}.github.io/{repo['name']}/"
+    return repo["html_url"], commit_sha, pages_url
 
 # === Notification ===
-def notify_evaluation_server(payload: dict):
-    url = str(payload.pop("evaluation_url"))
-    for i, delay in enumerate([1, 2, 4, 8]):
+class NotificationOutbox:
+    """
+    Durable outbox for evaluation callbacks. Build jobs only insert a row; an async dispatcher on the
+    app's event loop delivers it with jittered exponential backoff until NOTIFY_RETRY_HORIZON has passed,
+    reusing one HTTP client per evaluation host. Only transport errors, 408, 429 and 5xx answers are
+    retried; any other error status fails the row at once. Undelivered rows are replayed after a restart.
+    A row can be held until its Pages deployment is verified; held rows are re-armed after a restart.
+    """
+    BATCH_SIZE = 50
+
+    def __init__(self, db_path: str, horizon: int, backoff_base: float, backoff_max: float, timeout: float):
+        self.horizon = horizon
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._clients: Dict[str, httpx.AsyncClient] = {}
+        self._db = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                url TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                last_error TEXT,
+                created_at REAL NOT NULL,
+                next_attempt_at REAL NOT NULL,
+                held TEXT
+            )
+        """)
+        columns = {row[1] for row in self._db.execute("PRAGMA table_info(outbox)")}
+        if "held" not in columns:
+            self._db.execute("ALTER TABLE outbox ADD COLUMN held TEXT")
+
+    def enqueue(self, url: str, payload: dict, held: Optional[Dict] = None) -> int:
+        """
+        Persist a notification and wake the dispatcher. Safe to call from any thread.
+        With `held` (the deployment: owner, repo, commit_sha, deadline) it waits for release().
+        """
+        now = time.time()
+        with self._lock:
+            cursor = self._db.execute(
+                "INSERT INTO outbox (url, payload, status, created_at, next_attempt_at, held) VALUES (?, ?, ?, ?, ?, ?)",
+                (url, json.dumps(payload), "held" if held else "pending", now, now, json.dumps(held) if held else None),
+            )
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+        return cursor.lastrowid
+
+    def release(self, notification_id: int, verified: bool):
+        """Make a held notification due once its deployment is verified (or verification gave up)."""
+        if not verified:
+            print(f"Warning: Deployment for notification {notification_id} not verified within timeout.")
+        with self._lock:
+            self._db.execute(
+                "UPDATE outbox SET status = 'pending', held = NULL, created_at = ?, next_attempt_at = ? WHERE id = ? AND status = 'held'",
+                (time.time(), time.time(), notification_id),
+            )
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    def start(self):
+        """Start the dispatcher; must be called from the running event loop (e.g. a startup handler)."""
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        with self._lock:
+            pending = self._db.execute("SELECT COUNT(*) FROM outbox WHERE status = 'pending'").fetchone()[0]
+            held = self._db.execute("SELECT id, held FROM outbox WHERE status = 'held'").fetchall()
+        if pending:
+            print(f"Replaying {pending} pending evaluation notification(s).")
+        if held:
+            print(f"Re-arming Pages verification for {len(held)} held evaluation notification(s).")
+        for notification_id, deployment in held:
+            deployment = json.loads(deployment)
+            deployment_verifier.watch(
+                deployment["owner"], deployment["repo"], deployment["commit_sha"],
+                lambda verified, notification_id=notification_id: self.release(notification_id, verified),
+                timeout=deployment["deadline"] - time.time(),
+            )
+        self._loop.create_task(self._run())
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            rows = self._db.execute("SELECT status, COUNT(*) FROM outbox GROUP BY status").fetchall()
+        counts = {"held": 0, "pending": 0, "delivered": 0, "failed": 0}
+        counts.update(dict(rows))
+        return counts
+
+    def _client_for(self, url: str) -> httpx.AsyncClient:
+        parts = urlsplit(url)
+        host = f"{parts.scheme}://{parts.netloc}"
+        if host not in self._clients:
+            self._clients[host] = httpx.AsyncClient(timeout=self.timeout)
+        return self._clients[host]
+
+    async def _run(self):
+        while True:
+            try:
+                self._wakeup.clear()
+                with self._lock:
+                    due = self._db.execute(
+                        "SELECT id, url, payload, attempts, created_at FROM outbox WHERE status = 'pending' AND next_attempt_at <= ? ORDER BY next_attempt_at LIMIT ?",
+                        (time.time(), self.BATCH_SIZE),
+                    ).fetchall()
+                    next_due = self._db.execute("SELECT MIN(next_attempt_at) FROM outbox WHERE status = 'pending'").fetchone()[0]
+                if due:
+                    await asyncio.gather(*(self._deliver(*row) for row in due))
+                    continue
+                timeout = min(max(next_due - time.time(), 0), 60) if next_due else 60
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    pass
+            except Exception as e:
+                print(f"Notification dispatcher error: {e}")
+                traceback.print_exc()
+                await asyncio.sleep(1)
+
+    async def _deliver(self, notification_id: int, url: str, payload: str, attempts: int, created_at: float):
+        attempt = attempts + 1
         try:
-            response = requests.post(url, json=payload, timeout=20)
+            response = await self._client_for(url).post(url, content=payload, headers={"Content-Type": "application/json"})
             response.raise_for_status()
-            print(f"Successfully notified evaluation server on attempt {i+1}.")
-            return True
-        except requests.exceptions.RequestException as e:
-            print(f"Notification attempt {i+1} failed: {e}. Retrying in {delay}s...")
-            if i < 3: time.sleep(delay)
-    print("All notification attempts failed.")
-    return False
+        except httpx.HTTPError as e:
+            status = e.response.status_code if isinstance(e, httpx.HTTPStatusError) else None
+            error = f"HTTP {status}" if status else str(e) or type(e).__name__
+            delay = min(self.backoff_max, self.backoff_base * 2 ** attempts) * random.uniform(0.5, 1.5)
+            next_attempt_at = time.time() + delay
+            if status is not None and status not in (408, 429) and status < 500:
+                # The evaluation server rejected the notification itself; sending it again will not help
+                print(f"Notification {notification_id} attempt {attempt} failed: {error}. Not retryable, giving up.")
+                self._update(notification_id, "failed", attempt, error, time.time())
+            elif next_attempt_at > created_at + self.horizon:
+                print(f"Notification {notification_id} attempt {attempt} failed: {error}. Retry horizon exceeded, giving up.")
+                self._update(notification_id, "failed", attempt, error, next_attempt_at)
+            else:
+                print(f"Notification {notification_id} attempt {attempt} failed: {error}. Retrying in {delay:.1f}s...")
+                self._update(notification_id, "pending", attempt, error, next_attempt_at)
+            return
+        print(f"Successfully notified evaluation server on attempt {attempt}.")
+        self._update(notification_id, "delivered", attempt, None, time.time())
+
+    def _update(self, notification_id: int, status: str, attempts: int, error: Optional[str], next_attempt_at: float):
+        with self._lock:
+            self._db.execute(
+                "UPDATE outbox SET status = ?, attempts = ?, last_error = ?, next_attempt_at = ? WHERE id = ?",
+                (status, attempts, error, next_attempt_at, notification_id),
+            )
+
+notification_outbox = NotificationOutbox(
+    config.QUEUE_DB_PATH, config.NOTIFY_RETRY_HORIZON, config.NOTIFY_BACKOFF_BASE, config.NOTIFY_BACKOFF_MAX, config.NOTIFY_TIMEOUT,
+)
+
+def notify_evaluation_server(payload: dict, held: Optional[Dict] = None) -> Optional[int]:
+    """Hand the notification to the durable outbox; delivery and retries happen asynchronously."""
+    url = str(payload.pop("evaluation_url"))
+    try:
+        notification_id = notification_outbox.enqueue(url, payload, held)
+    except sqlite3.Error as e:
+        print(f"Could not enqueue evaluation notification: {e}")
+        return None
+    print(f"Queued evaluation notification {notification_id} for {url}.")
+    return notification_id
 
 # === Background task ===
-def run_build_and_deploy_task(request_data: BuildRequest):
+async def run_build_and_deploy_task(request_data: BuildRequest):
     print(f"Starting background task for '{request_data.task}', round {request_data.round}.")
+    github_stats.begin_job()
+    metrics.begin_job(request_data.task, request_data.round)
+    started = time.perf_counter()
     try:
         if request_data.round == 1:
-            # === MODIFIED LINE ===
-            generated_files, binary_files = generate_code_from_brief(request_data)
-            repo_url, commit_sha, pages_url = create_and_deploy(request_data, generated_files, binary_files)
+            # Create the repo first so blobs can be uploaded while the LLM is still streaming
+            repo = await get_or_create_task_repo(request_data.task)
+            uploader = BlobUploader(repo) if config.DEPLOY_BACKEND == "api" else None
+            generated_files, binary_files = await generate_code_from_brief(request_data, on_file=uploader.submit if uploader else None)
+            repo_url, commit_sha, pages_url = await create_and_deploy(request_data, generated_files, binary_files, uploader)
         else:
-            g = Github(config.GITHUB_TOKEN)
-            user = g.get_user()
-            repo = g.get_repo(f"{user.login}/{request_data.task}")
-
-            file_content = get_existing_file(repo, "index.html") # This will only get index.html, see note below
-            if not file_content: raise ValueError("Could not retrieve existing code for revision.")
+            repo = await get_task_repo(request_data.task)
 
-            existing_code = file_content.decoded_content.decode("utf-8")
+            # Load the whole repository in one call so the model sees every file, not just index.html
+            existing_files, other_files = await load_task_snapshot(repo)
+            if not existing_files: raise ValueError("Could not retrieve existing code for revision.")
 
-
-            generated_files, binary_files = generate_code_from_brief(request_data, existing_code)
-            repo_url, commit_sha, pages_url = revise_and_deploy(request_data, generated_files, binary_files)
+            uploader = BlobUploader(repo) if config.DEPLOY_BACKEND == "api" else None
+            generated_files, binary_files = await generate_code_from_brief(
+                request_data, existing_files, on_file=uploader.submit if uploader else None, other_files=other_files
+            )
+            repo_url, commit_sha, pages_url = await revise_and_deploy(request_data, generated_files, binary_files, uploader, existing_files)
 
         notification_payload = {
             "email": request_data.email, "task": request_data.task,
@@ -510,31 +2693,260 @@ def run_build_and_deploy_task(request_data: BuildRequest):
             "pages_url": pages_url, "evaluation_url": str(request_data.evaluation_url)
         }
 
-        notified = notify_evaluation_server(notification_payload)
-        if not notified:
-            print(f"CRITICAL (background): Build for '{request_data.task}' succeeded, but FAILED to notify server.")
+        # Persisted before the job is marked done and held until the Pages build is verified, so a restart
+        # during verification re-arms it instead of losing the callback
+        deployment = {
+            "owner": config.GITHUB_USERNAME, "repo": request_data.task, "commit_sha": commit_sha,
+            "deadline": time.time() + config.DEPLOYMENT_TIMEOUT,
+        }
+        notification_id = notify_evaluation_server(notification_payload, held=deployment)
+        if notification_id is None:
+            raise RuntimeError(f"Build for '{request_data.task}' succeeded, but the notification could not be queued.")
+
+        # The worker is released now; the shared verifier releases the notification once the Pages build is done
+        deployment_verifier.watch(
+            config.GITHUB_USERNAME, request_data.task, commit_sha,
+            lambda verified: notification_outbox.release(notification_id, verified),
+        )
 
-        print(f"Background task for '{request_data.task}' completed successfully!")
+        print(f"Background task for '{request_data.task}' completed successfully! GitHub API requests: {github_stats.job_requests()}")
+        metrics.inc("build_jobs_total", status="done")
 
     except Exception as e:
         print(f"FATAL ERROR in background task for '{request_data.task}': {e}")
         traceback.print_exc()
+        metrics.inc("build_jobs_total", status="failed")
+        raise
+    finally:
+        metrics.observe("build_job_seconds", time.perf_counter() - started)
 
-# === API endpoint ===
-@app.post("/api/build")
-def handle_build_request(request_data: BuildRequest, background_tasks: BackgroundTasks):
-    if request_data.secret != config.MY_SECRET:
-        raise HTTPException(status_code=403, detail="Authentication failed: Invalid secret.")
-
-    if not all([config.AIPIPE_TOKEN, config.GITHUB_TOKEN, config.GITHUB_USERNAME]):
-        raise HTTPException(status_code=503, detail="Server is not fully configured. Missing environment variables.")
+# === Build queue ===
+class BuildQueue:
+    """
+    Durable SQLite-backed build queue drained by `workers` worker tasks on the app's event loop, so the
+    number of concurrent builds is not tied to OS threads. Submissions are deduplicated on
+    (task, round, nonce); jobs left running by a crash are re-queued on start.
+    """
 
-    request_data.task = sanitize_filename(request_data.task)
+    def __init__(self, db_path: str, handler: Callable[[BuildRequest], Awaitable[None]], workers: int, max_attempts: int):
+        self.handler = handler
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._tasks: List[asyncio.Task] = []
+        self._db = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                task TEXT NOT NULL,
+                round INTEGER NOT NULL,
+                nonce TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'queued',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                error TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL,
+                UNIQUE (task, round, nonce)
+            )
+        """)
+
+    def enqueue(self, request_data: BuildRequest) -> Tuple[int, bool]:
+        """
+        Persist a job and wake a worker. Returns (job id, created); created is False for a duplicate
+        of a queued, running or done job. Resubmitting a failed job queues it again.
+        """
+        # The shared secret has already been checked and is not stored on disk
+        payload = request_data.model_copy(update={"secret": ""}).model_dump_json()
+        now = time.time()
+        with self._lock:
+            cursor = self._db.execute(
+                "INSERT OR IGNORE INTO jobs (task, round, nonce, payload, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (request_data.task, request_data.round, request_data.nonce, payload, now, now),
+            )
+            job_id = cursor.lastrowid
+            if not cursor.rowcount:
+                job_id, status = self._db.execute(
+                    "SELECT id, status FROM jobs WHERE task = ? AND round = ? AND nonce = ?",
+                    (request_data.task, request_data.round, request_data.nonce),
+                ).fetchone()
+                if status != "failed":
+                    return job_id, False
+                self._db.execute(
+                    "UPDATE jobs SET status = 'queued', error = NULL, attempts = 0, payload = ?, created_at = ?, updated_at = ? WHERE id = ?",
+                    (payload, now, now, job_id),
+                )
+                print(f"Re-queued failed job {job_id} for '{request_data.task}', round {request_data.round}.")
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+        return job_id, True
+
+    def start(self):
+        """Re-queue jobs interrupted by a previous crash and start the workers; call from the running event loop."""
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        with self._lock:
+            self._db.execute(
+                "UPDATE jobs SET status = 'failed', error = 'Too many attempts', updated_at = ? WHERE status = 'running' AND attempts >= ?",
+                (time.time(), self.max_attempts),
+            )
+            resumed = self._db.execute(
+                "UPDATE jobs SET status = 'queued', updated_at = ? WHERE status = 'running'", (time.time(),)
+            ).rowcount
+            pending = self._db.execute("SELECT payload FROM jobs WHERE status = 'queued'").fetchall()
+        if resumed:
+            print(f"Resuming {resumed} interrupted build job(s).")
+        # Keep the stored attachments of waiting jobs out of eviction
+        for (payload,) in pending:
+            attachment_store.pin(stored_attachment_ids(BuildRequest.model_validate_json(payload)))
+        self._tasks = [self._loop.create_task(self._worker_loop()) for _ in range(self.workers)]
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            rows = self._db.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        counts = {"queued": 0, "running": 0, "done": 0, "failed": 0}
+        counts.update(dict(rows))
+        return counts
+
+    def get_job(self, job_id: int) -> Optional[Dict]:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT id, task, round, nonce, status, attempts, error, created_at, updated_at FROM jobs WHERE id = ?",
+                (job_id,),
+            ).fetchone()
+        if not row:
+            return None
+        keys = ("id", "task", "round", "nonce", "status", "attempts", "error", "created_at", "updated_at")
+        return dict(zip(keys, row))
+
+    async def _claim(self) -> Tuple[int, str, float]:
+        while True:
+            # Clear before looking, so an enqueue between the query and the wait is not missed
+            self._wakeup.clear()
+            with self._lock:
+                row = self._db.execute("SELECT id, payload, created_at FROM jobs WHERE status = 'queued' ORDER BY id LIMIT 1").fetchone()
+                if row:
+                    self._db.execute(
+                        "UPDATE jobs SET status = 'running', attempts = attempts + 1, updated_at = ? WHERE id = ?",
+                        (time.time(), row[0]),
+                    )
+                    return row
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=5)
+            except asyncio.TimeoutError:
+                pass
+
+    def _finish(self, job_id: int, status: str, error: Optional[str] = None):
+        with self._lock:
+            self._db.execute(
+                "UPDATE jobs SET status = ?, error = ?, updated_at = ? WHERE id = ?",
+                (status, error, time.time(), job_id),
+            )
+
+    async def _worker_loop(self):
+        while True:
+            job_id, payload, created_at = await self._claim()
+            request_data: Optional[BuildRequest] = None
+            try:
+                request_data = BuildRequest.model_validate_json(payload)
+                # GitHub writes of the jobs closest to their deadline go first
+                deadline = config.BUILD_DEADLINE if request_data.round == 1 else config.REVISION_DEADLINE
+                github_scheduler.begin_job(created_at + deadline)
+                await self.handler(request_data)
+            except Exception as e:
+                self._finish(job_id, "failed", str(e))
+            else:
+                self._finish(job_id, "done")
+            # Attachments stored at ingestion stay pinned until the job is over
+            if request_data is not None:
+                attachment_store.unpin(stored_attachment_ids(request_data))
 
-    # Use background task to run the heavy process
-    background_tasks.add_task(run_build_and_deploy_task, request_data)
+build_queue = BuildQueue(config.QUEUE_DB_PATH, run_build_and_deploy_task, config.BUILD_WORKERS, config.BUILD_MAX_ATTEMPTS)
 
-    return {"status": "accepted", "message": "The build and deploy process has been started in the background."}
+# === API endpoint ===
+def inline_schema_refs(schema: Dict) -> Dict:
+    """Resolve the local $defs of a pydantic JSON schema so it can be embedded in the OpenAPI document."""
+    definitions = schema.pop("$defs", {})
+
+    def resolve(node):
+        if isinstance(node, dict):
+            if "$ref" in node:
+                return resolve(definitions[node["$ref"].rsplit("/", 1)[-1]])
+            return {key: resolve(value) for key, value in node.items()}
+        if isinstance(node, list):
+            return [resolve(value) for value in node]
+        return node
+    return resolve(schema)
+
+BUILD_REQUEST_BODY = {"requestBody": {"required": True, "content": {"application/json": {"schema": inline_schema_refs(BuildRequest.model_json_schema())}}}}
+
+@app.post("/api/build", openapi_extra=BUILD_REQUEST_BODY)
+async def handle_build_request(request: Request):
+    # The body is parsed here rather than by FastAPI so data URL attachments are decoded as they stream in
+    extractor = DataURLExtractor()
+    try:
+        body = bytearray()
+        async for chunk in request.stream():
+            body += extractor.feed(chunk)
+            if extractor.over_limit:
+                raise HTTPException(status_code=413, detail=f"Attachments exceed MAX_REQUEST_ATTACHMENT_BYTES ({config.MAX_REQUEST_ATTACHMENT_BYTES} bytes).")
+        body += extractor.finish()
+        try:
+            request_data = BuildRequest.model_validate_json(body)
+        except ValidationError as e:
+            raise RequestValidationError(e.errors(include_url=False, include_input=False))
+
+        if request_data.secret != config.MY_SECRET:
+            raise HTTPException(status_code=403, detail="Authentication failed: Invalid secret.")
+
+        if not all([config.AIPIPE_TOKEN, config.GITHUB_TOKEN, config.GITHUB_USERNAME]):
+            raise HTTPException(status_code=503, detail="Server is not fully configured. Missing environment variables.")
+
+        request_data.task = sanitize_filename(request_data.task)
+
+        # Persist the job; the worker pool runs the heavy process
+        job_id, created = build_queue.enqueue(request_data)
+    except BaseException:
+        extractor.discard()
+        raise
+    if not created:
+        extractor.discard()
+        print(f"Duplicate submission for '{request_data.task}', round {request_data.round}; already queued as job {job_id}.")
+
+    return {"status": "accepted", "message": "The build and deploy process has been started in the background.", "job_id": job_id}
+
+@app.get("/api/queue")
+async def queue_status():
+    return {
+        "workers": build_queue.workers, "jobs": build_queue.stats(),
+        "pending_deployments": deployment_verifier.pending(), "notifications": notification_outbox.stats(),
+    }
+
+@app.get("/api/cache")
+async def cache_status():
+    return {"llm": generation_cache.stats(), "attachments": attachment_store.stats(), "github": github_stats.snapshot()}
+
+@app.get("/api/jobs/{job_id}")
+async def job_status(job_id: int):
+    job = build_queue.get_job(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found.")
+    job["spans"] = metrics.job_spans(job["task"], job["round"])
+    return job
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics_endpoint():
+    # Queue-level gauges are read at scrape time
+    for status, count in build_queue.stats().items():
+        metrics.set("build_queue_jobs", count, status=status)
+    for status, count in notification_outbox.stats().items():
+        metrics.set("notifications", count, status=status)
+    metrics.set("pages_pending_deployments", deployment_verifier.pending())
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
 
 
 @app.get("/")